@@ -0,0 +1,107 @@
+import math
+import os
+import threading
+import time
+from fastapi import HTTPException
+import async_db
+from cache import TTLCache
+from database import pool_stats
+
+# the buckets and the writes in flight are counted by each worker, the
+# limits apply per worker
+# buckets of this many users are kept, the least recently seen are dropped
+RATE_LIMIT_USERS = int(os.getenv("RATE_LIMIT_USERS", 10000))
+# write requests running at once, over it they get a 503, 0 for no limit
+MAX_CONCURRENT_WRITES = int(os.getenv("MAX_CONCURRENT_WRITES", 0))
+
+
+def parse_rate(rate):
+    """
+        "30/60" -> 30 requests every 60 seconds, None when empty or 0
+    """
+    if not rate:
+        return None
+    count, _, seconds = rate.partition("/")
+    count, seconds = int(count), float(seconds or 1)
+    if count <= 0:
+        return None
+    return count, seconds
+
+
+class RateLimiter():
+    """
+        token bucket per key: up to count requests at once, then one more
+        every seconds / count
+    """
+
+    def __init__(self, count, seconds, maxsize=RATE_LIMIT_USERS):
+        self.count = count
+        self.rate = count / seconds
+        # an idle bucket is full again after seconds, it can be forgotten
+        self._buckets = TTLCache(maxsize, seconds)
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """
+            take a token, returns 0 or the seconds until one is available
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.count, now))
+            tokens = min(self.count, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._buckets.set(key, (tokens, now))
+                return (1 - tokens) / self.rate
+            self._buckets.set(key, (tokens - 1, now))
+            return 0
+
+
+class ConcurrencyLimiter():
+    """
+        counts the requests in flight, refuses new ones over the limit or
+        when every connection of the peewee pool or of the async pool is
+        taken instead of letting them wait for a connection until they time
+        out
+    """
+
+    def __init__(self, limit=MAX_CONCURRENT_WRITES):
+        self.limit = limit
+        self._in_flight = 0
+        self._shed = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # the peewee pool and the pool of the async endpoints
+        full = any(stats and stats["in_use"] >= stats["max_size"]
+                   for stats in (pool_stats(), async_db.pool_stats()))
+        with self._lock:
+            if (self.limit and self._in_flight >= self.limit) or full:
+                self._shed += 1
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "in_flight": self._in_flight,
+            "shed": self._shed
+        }
+
+
+def too_many_requests(retry_after):
+    return HTTPException(
+        status_code=429,
+        detail="Too many requests",
+        headers={"Retry-After": str(math.ceil(retry_after))})
+
+
+def service_unavailable(retry_after=1):
+    return HTTPException(
+        status_code=503,
+        detail="Server is busy",
+        headers={"Retry-After": str(retry_after)})
@@ -0,0 +1,337 @@
+import asyncio
+import os
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from playhouse.pool import MaxConnectionsExceeded
+from starlette.concurrency import run_in_threadpool
+from database import (
+    record_query,
+    DB_POOL_WAIT_TIMEOUT,
+    DB_ENGINE,
+    DB_NAME,
+    DB_USER,
+    DB_PW,
+    DB_HOST,
+    DB_PORT
+)
+from models import Post
+from helper import (
+    attach_likes as attach_likes_sync,
+    get_recent_likes_query,
+    insert_likes_query,
+    record_likes_queries,
+    add_like as add_like_sync
+)
+
+# run the queries of the async endpoints with an async driver (aiomysql, or
+# aiosqlite with DB_ENGINE=sqlite) instead of peewee in the threadpool
+ASYNC_DB = os.getenv("ASYNC_DB", "false").lower() in ("1", "true", "yes")
+ASYNC_DB_POOL_SIZE = int(os.getenv("ASYNC_DB_POOL_SIZE", 20))
+
+# the queries are the peewee queries of helper.py, rendered with .sql() for
+# the dialect of db and run by the driver, the rows are then converted by
+# the peewee cursor wrapper of the query so they are the same as with
+# peewee (datetimes, aliases, dicts)
+
+
+class FetchedCursor():
+    """
+        DB-API cursor over rows already read, for the peewee cursor wrappers
+    """
+
+    def __init__(self, description, rows):
+        self.description = description
+        self._rows = iter(rows)
+
+    def fetchone(self):
+        return next(self._rows, None)
+
+    def close(self):
+        pass
+
+
+class Result():
+    def __init__(self, rowcount, lastrowid):
+        self.rowcount = rowcount
+        self.lastrowid = lastrowid
+
+
+class AsyncConnection():
+    """
+        a connection of the pool, runs peewee queries
+        a driver subclass adds run(sql, params), returning (description,
+        rows, rowcount, lastrowid), and begin, commit and rollback
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def _timed(self, query):
+        sql, params = query.sql()
+        started = time.perf_counter()
+        try:
+            return await self.run(sql, params)
+        finally:
+            record_query(sql, params, time.perf_counter() - started)
+
+    async def fetch(self, query):
+        description, rows, _, _ = await self._timed(query)
+        return list(query._get_cursor_wrapper(
+            FetchedCursor(description, rows)))
+
+    async def execute(self, query):
+        _, _, rowcount, lastrowid = await self._timed(query)
+        return Result(rowcount, lastrowid)
+
+
+class MySQLConnection(AsyncConnection):
+    async def run(self, sql, params):
+        async with self.conn.cursor() as cursor:
+            await cursor.execute(sql, params)
+            rows = await cursor.fetchall()
+            return (cursor.description, rows,
+                    cursor.rowcount, cursor.lastrowid)
+
+    async def begin(self):
+        await self.conn.begin()
+
+    async def commit(self):
+        await self.conn.commit()
+
+    async def rollback(self):
+        await self.conn.rollback()
+
+
+class SqliteConnection(AsyncConnection):
+    async def run(self, sql, params):
+        cursor = await self.conn.execute(sql, params)
+        try:
+            rows = await cursor.fetchall()
+            return (cursor.description, rows,
+                    cursor.rowcount, cursor.lastrowid)
+        finally:
+            await cursor.close()
+
+    async def begin(self):
+        await self.conn.execute("BEGIN")
+
+    async def commit(self):
+        await self.conn.execute("COMMIT")
+
+    async def rollback(self):
+        await self.conn.execute("ROLLBACK")
+
+
+class AsyncDatabase():
+    """
+        pool of async connections, opened on first use
+        a driver subclass adds create_pool, the connection context manager,
+        stats and close
+    """
+
+    def __init__(self, pool_size):
+        self.pool_size = pool_size
+        self._pool = None
+        self._lock = None
+
+    async def _ensure_pool(self):
+        if self._pool is None:
+            # created here, the lock has to belong to the running loop
+            self._lock = self._lock or asyncio.Lock()
+            async with self._lock:
+                if self._pool is None:
+                    self._pool = await self.create_pool()
+        return self._pool
+
+    async def _wait(self, acquire):
+        """
+            a connection of the pool, waiting DB_POOL_WAIT_TIMEOUT at most
+            like the peewee pool, then the request gets a 503
+        """
+        try:
+            return await asyncio.wait_for(acquire, DB_POOL_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise MaxConnectionsExceeded(
+                "No async connection free after {}s".format(
+                    DB_POOL_WAIT_TIMEOUT))
+
+    @asynccontextmanager
+    async def transaction(self):
+        async with self.connection() as conn:
+            await conn.begin()
+            try:
+                yield conn
+            except BaseException:
+                await conn.rollback()
+                raise
+            await conn.commit()
+
+    async def fetch(self, query):
+        async with self.connection() as conn:
+            return await conn.fetch(query)
+
+    async def execute(self, query):
+        async with self.connection() as conn:
+            return await conn.execute(query)
+
+
+class MySQLAsyncDatabase(AsyncDatabase):
+    async def create_pool(self):
+        import aiomysql
+        return await aiomysql.create_pool(
+            minsize=1,
+            maxsize=self.pool_size,
+            host=DB_HOST,
+            port=DB_PORT,
+            user=DB_USER,
+            password=DB_PW or "",
+            db=DB_NAME,
+            autocommit=True)
+
+    @asynccontextmanager
+    async def connection(self):
+        pool = await self._ensure_pool()
+        conn = await self._wait(pool.acquire())
+        try:
+            yield MySQLConnection(conn)
+        finally:
+            await pool.release(conn)
+
+    def stats(self):
+        if self._pool is None:
+            return None
+        return {
+            "max_size": self._pool.maxsize,
+            "in_use": self._pool.size - self._pool.freesize
+        }
+
+    async def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            await self._pool.wait_closed()
+            self._pool = None
+
+
+class SqliteAsyncDatabase(AsyncDatabase):
+    """
+        for tests and benchmarks, aiosqlite runs every connection in a
+        thread of its own
+    """
+
+    async def create_pool(self):
+        import aiosqlite
+        pool = asyncio.Queue()
+        for _ in range(self.pool_size):
+            # autocommit, transactions are begun explicitly
+            conn = await aiosqlite.connect(DB_NAME, isolation_level=None)
+            await conn.execute("PRAGMA journal_mode=wal")
+            pool.put_nowait(conn)
+        return pool
+
+    @asynccontextmanager
+    async def connection(self):
+        pool = await self._ensure_pool()
+        conn = await self._wait(pool.get())
+        try:
+            yield SqliteConnection(conn)
+        finally:
+            pool.put_nowait(conn)
+
+    def stats(self):
+        if self._pool is None:
+            return None
+        return {
+            "max_size": self.pool_size,
+            "in_use": self.pool_size - self._pool.qsize()
+        }
+
+    async def close(self):
+        if self._pool is not None:
+            while not self._pool.empty():
+                await self._pool.get_nowait().close()
+            self._pool = None
+
+
+adb = None
+if ASYNC_DB:
+    if DB_ENGINE == "sqlite":
+        adb = SqliteAsyncDatabase(ASYNC_DB_POOL_SIZE)
+    else:
+        adb = MySQLAsyncDatabase(ASYNC_DB_POOL_SIZE)
+
+
+async def connect():
+    # open the pool before the first request needs it
+    if adb is not None:
+        await adb._ensure_pool()
+
+
+async def close():
+    if adb is not None:
+        await adb.close()
+
+
+def pool_stats():
+    """
+        usage of the async pool as database.pool_stats, None without
+        ASYNC_DB or before the pool is opened
+    """
+    return adb.stats() if adb is not None else None
+
+# ------------------------ Queries of the endpoints ------------------------ #
+# without ASYNC_DB they run the sync helpers in the threadpool
+
+
+async def fetch(query):
+    """
+        the rows of the query as its row type (dicts, tuples...) would give
+    """
+    if adb is None:
+        return await run_in_threadpool(list, query)
+    return await adb.fetch(query)
+
+
+async def attach_likes(posts, fields):
+    """
+        same as helper.attach_likes
+    """
+    if adb is None:
+        return await run_in_threadpool(attach_likes_sync, posts, fields)
+    if "likes" not in fields:
+        return posts
+    post_ids = [post["id"] for post in posts]
+    likes = defaultdict(list)
+    if post_ids:
+        for like in await adb.fetch(get_recent_likes_query(post_ids).dicts()):
+            likes[like.pop("post_id")].append(like)
+    for post in posts:
+        post["likes"] = likes.get(post["id"], [])
+    return posts
+
+
+async def fetch_posts(query, fields):
+    """
+        the posts of the query as dicts with their latest likes
+    """
+    return await attach_likes(await fetch(query.dicts()), fields)
+
+
+async def post_exists(post_id):
+    query = Post.select(Post.id).where(Post.id == post_id).limit(1)
+    return bool(await fetch(query.tuples()))
+
+
+async def add_like(post_id, user_id):
+    """
+        same as helper.add_like
+    """
+    if adb is None:
+        return await run_in_threadpool(add_like_sync, post_id, user_id)
+    async with adb.transaction() as conn:
+        result = await conn.execute(insert_likes_query([post_id], user_id))
+        if not result.rowcount:
+            return None
+        for query in record_likes_queries([post_id], user_id):
+            await conn.execute(query)
+    return result.lastrowid
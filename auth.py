@@ -1,19 +1,26 @@
 from pydoc import plain
+import os
 import jwt
-from fastapi import HTTPException, Security
+from fastapi import HTTPException, Request, Security
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from fastapi.responses import RedirectResponse
 from passlib.context import CryptContext
 from playhouse.shortcuts import model_to_dict
+from cache import TTLCache
 from exception import RequiresExtraInfoException
 from models import User
 from datetime import datetime, timedelta
 
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 1024))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 60))
+
 
 class AuthHandler():
     security = HTTPBearer()
     pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
     secret = "SECRET"
+    # decoded users by email, shared by all requests of the worker
+    user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
 
     def encode_token(self, user_email):
         payload = {
@@ -31,28 +38,56 @@ class AuthHandler():
     def decode_token(self, token):
         try:
             payload = jwt.decode(token, self.secret, algorithms=['HS256'])
-            user = (User.select()
-                        .where(User.email == payload['sub'])
-                        .first())
-            if not user:
-                raise HTTPException(status_code=401, detail="User not exists")
-            self.user = user
-            return model_to_dict(user)
         except jwt.ExpiredSignatureError:
             raise HTTPException(status_code=401, detail='Expired token')
         except jwt.InvalidTokenError:
             raise HTTPException(status_code=401, detail="Invalid token")
+        return self.get_user(payload['sub'])
+
+    def get_user(self, email):
+        user = self.user_cache.get(email)
+        if user is None:
+            user = (User.select()
+                        .where(User.email == email)
+                        .first())
+            if not user:
+                raise HTTPException(status_code=401, detail="User not exists")
+            user = model_to_dict(user)
+            self.user_cache.set(email, user)
+        return dict(user)
+
+    def cache_user(self, user):
+        """
+            keep a user record read elsewhere, to warm the cache at startup
+        """
+        self.user_cache.set(user["email"], dict(user))
+
+    def invalidate_user(self, email):
+        """
+            must be called after the user record changes
+        """
+        self.user_cache.pop(email)
+
+    def resolve_user(self, request, auth):
+        # decode the token only once per request, the user is kept on the
+        # request so concurrent requests never share it
+        user = getattr(request.state, "user", None)
+        if user is None:
+            user = self.decode_token(auth.credentials)
+            request.state.user = user
+        return user
 
     def auth_wrapper(
             self,
+            request: Request,
             auth: HTTPAuthorizationCredentials = Security(security)):
-        return self.decode_token(auth.credentials)
+        return self.resolve_user(request, auth)
 
     def verify_information(
             self,
+            request: Request,
             auth: HTTPAuthorizationCredentials = Security(security)):
-        if not self.user:
-            self.user = self.decode_token(auth.credentials)
+        user = self.resolve_user(request, auth)
         # if not add extra information -> redirect to form
-        if not self.user.name:
+        if not user["name"]:
             raise RequiresExtraInfoException
@@ -0,0 +1,20 @@
+import argparse
+from helper import (
+    rebuild_like_projections,
+    rebuild_trending,
+    rebuild_user_stats
+)
+
+# rebuild the denormalized tables from the base tables
+commands = {
+    "likes": rebuild_like_projections,
+    "trending": rebuild_trending,
+    "users": rebuild_user_stats,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Backfill or repair denormalized tables")
+    parser.add_argument("command", choices=sorted(commands))
+    args = parser.parse_args()
+    commands[args.command]()
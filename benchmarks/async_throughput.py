@@ -0,0 +1,62 @@
+"""
+    throughput of the post endpoints with the sync (peewee in the threadpool)
+    and the async (ASYNC_DB) data access layer
+
+    the app is started under uvicorn once per mode with the response cache
+    off, so every request reaches the database, and the same request log is
+    replayed at every concurrency
+    use a database filled by benchmarks/seed.py:
+        DB_ENGINE=sqlite DB_NAME=/tmp/bench.db \\
+            python benchmarks/async_throughput.py benchmarks/requests.jsonl \\
+            --concurrency 10 50 200
+"""
+import argparse
+import asyncio
+import json
+import os
+
+import replay
+
+
+def run_mode(args, lines, async_db):
+    os.environ["ASYNC_DB"] = "true" if async_db else "false"
+    os.environ["RESPONSE_CACHE_SIZE"] = "0"
+    process, url = replay.serve(args.port)
+    results = []
+    try:
+        for concurrency in args.concurrency:
+            run_args = argparse.Namespace(
+                url=url, serve=False, timeout=args.timeout,
+                concurrency=concurrency)
+            report = asyncio.run(replay.run(run_args, lines))
+            total = report["total"]
+            results.append({
+                "mode": "async" if async_db else "sync",
+                "concurrency": concurrency,
+                "rps": total["rps"],
+                "p50_ms": total["p50_ms"],
+                "p99_ms": total["p99_ms"],
+                "errors": total["errors"]
+            })
+    finally:
+        process.terminate()
+        process.wait()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("requests_file")
+    parser.add_argument("--concurrency", type=int, nargs="+",
+                        default=[10, 50, 200])
+    parser.add_argument("--limit", type=int, default=2000,
+                        help="replay only the first lines")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    # the log of seed.py only has the feed, post, user posts and like
+    # requests, the endpoints with an async version
+    lines = replay.load(args.requests_file, args.limit)
+    results = run_mode(args, lines, False) + run_mode(args, lines, True)
+    print(json.dumps(results, indent=2))
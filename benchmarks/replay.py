@@ -0,0 +1,211 @@
+"""
+    replay a JSONL request log against the app and report latency,
+    throughput and database queries per endpoint
+
+    one request per line:
+        {"method": "GET", "path": "/api/posts?page=1",
+         "email": "user1@example.com", "body": null}
+    email is optional, the request is then sent without a token
+
+    by default the app runs in process, pass --serve to start it under
+    uvicorn or --url to hit a running server, DB queries and time are read
+    from the Server-Timing header in every case
+
+    usage:
+        DB_ENGINE=sqlite DB_NAME=/tmp/bench.db \\
+            python benchmarks/replay.py benchmarks/requests.jsonl \\
+            --concurrency 10 --output bench.jsonl
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from auth import AuthHandler  # noqa: E402
+
+# written by the metrics middleware of the app
+_server_timing = re.compile(r'db;dur=([\d.]+);desc="(\d+) queries"')
+
+
+def db_timing(res):
+    """
+        (queries, db milliseconds) of a response, None when the server
+        did not send them
+    """
+    match = _server_timing.search(res.headers.get("server-timing", ""))
+    if not match:
+        return None, None
+    return int(match.group(2)), float(match.group(1))
+
+
+def endpoint(method, path):
+    # /api/posts/42/likes?x=1 -> GET /api/posts/{id}/likes
+    path = path.split("?", 1)[0]
+    return "{} {}".format(method, re.sub(r"/\d+", "/{id}", path))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+def load(path, limit):
+    with open(path) as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    if limit:
+        lines = lines[:limit]
+    return lines
+
+
+async def replay(client, lines, concurrency):
+    tokens = {}
+    auth_handler = AuthHandler()
+    results = []
+    queue = asyncio.Queue()
+    for line in lines:
+        queue.put_nowait(line)
+
+    async def worker():
+        while not queue.empty():
+            line = queue.get_nowait()
+            headers = {}
+            email = line.get("email")
+            if email:
+                if email not in tokens:
+                    tokens[email] = auth_handler.encode_token(email)
+                headers["Authorization"] = "Bearer " + tokens[email]
+            method = line.get("method", "GET")
+            started = time.perf_counter()
+            try:
+                res = await client.request(
+                    method, line["path"], json=line.get("body"),
+                    headers=headers)
+                status = res.status_code
+                await res.aread()
+                queries, db_ms = db_timing(res)
+            except httpx.HTTPError:
+                status = None
+                queries, db_ms = None, None
+            results.append({
+                "endpoint": endpoint(method, line["path"]),
+                "status": status,
+                "seconds": time.perf_counter() - started,
+                "queries": queries,
+                "db_ms": db_ms
+            })
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return results, time.perf_counter() - started
+
+
+def summarize(results, elapsed):
+    def stats(rows):
+        latencies = [row["seconds"] * 1000 for row in rows]
+        timed = [row for row in rows if row["queries"] is not None]
+        return {
+            "requests": len(rows),
+            # redirects are the extra information form, not failures
+            "errors": sum(1 for row in rows
+                          if row["status"] is None or row["status"] >= 400),
+            "rps": round(len(rows) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 50), 2),
+            "p95_ms": round(percentile(latencies, 95), 2),
+            "p99_ms": round(percentile(latencies, 99), 2),
+            "queries_per_request": (
+                round(sum(row["queries"] for row in timed) / len(timed), 2)
+                if timed else None),
+            "db_ms_per_request": (
+                round(sum(row["db_ms"] for row in timed) / len(timed), 2)
+                if timed else None)
+        }
+
+    by_endpoint = defaultdict(list)
+    for row in results:
+        by_endpoint[row["endpoint"]].append(row)
+    return {
+        "total": stats(results),
+        "endpoints": {name: stats(rows)
+                      for name, rows in sorted(by_endpoint.items())}
+    }
+
+
+def serve(port):
+    # same env as this process, so DB_ENGINE / DB_NAME carry over
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app",
+         "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT)
+    url = "http://127.0.0.1:{}".format(port)
+    for _ in range(100):
+        try:
+            httpx.get(url + "/docs")
+            return process, url
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("uvicorn did not start")
+
+
+async def run(args, lines):
+    process = None
+    if args.url or args.serve:
+        if args.serve:
+            process, args.url = serve(args.port)
+        client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout)
+    else:
+        import main
+        client = httpx.AsyncClient(
+            app=main.app,
+            base_url="http://testserver",
+            timeout=args.timeout)
+    try:
+        async with client:
+            results, elapsed = await replay(client, lines, args.concurrency)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+    return summarize(results, elapsed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("requests_file")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--limit", type=int, default=0,
+                        help="replay only the first lines")
+    parser.add_argument("--url", help="base url of a running server")
+    parser.add_argument("--serve", action="store_true",
+                        help="start the app under uvicorn")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--label", default="",
+                        help="stored with the results, e.g. a commit")
+    parser.add_argument("--output",
+                        help="append the results as one json line")
+    args = parser.parse_args()
+
+    lines = load(args.requests_file, args.limit)
+    report = {
+        "label": args.label,
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "concurrency": args.concurrency,
+    }
+    report.update(asyncio.run(run(args, lines)))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(report) + "\n")
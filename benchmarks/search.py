@@ -0,0 +1,81 @@
+"""
+    search latency while the Post table grows
+
+    posts are added up to every size and the same few posts contain the
+    searched word, the index lookup should stay flat while a LIKE scan
+    grows with the table
+    the posts are inserted into the configured database, use an empty one:
+        DB_ENGINE=sqlite DB_NAME=/tmp/search.db \\
+            python benchmarks/search.py --sizes 1000 10000 100000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import Post  # noqa: E402
+from search import get_search_index  # noqa: E402
+import migrate  # noqa: E402
+import seed  # noqa: E402
+
+TERM = "zyzzyva"
+MATCHES = 10
+
+
+def gen_posts(rng, start, count):
+    for post_id in range(start, start + count):
+        yield (post_id,
+               " ".join(rng.choices(seed.WORDS, k=8)),
+               " ".join(rng.choices(seed.WORDS, k=rng.randint(20, 200))),
+               1)
+
+
+def timed(func, runs):
+    started = time.perf_counter()
+    for _ in range(runs):
+        result = func()
+    return (time.perf_counter() - started) / runs * 1000, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000, 10000, 100000])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    migrate.migrate()
+    fields = [Post.id, Post.title, Post.body, Post.author]
+    # the matching posts are the first ones, later sizes only add noise
+    seed.insert(Post, fields, [
+        (post_id, "post about " + TERM, "lorem ipsum " + TERM, 1)
+        for post_id in range(1, MATCHES + 1)], 1000)
+    count = MATCHES
+    results = []
+    for size in args.sizes:
+        seed.insert(Post, fields, gen_posts(rng, count + 1, size - count),
+                    1000)
+        count = size
+        index = get_search_index()
+        # the first search builds the in memory index (SQLite)
+        build_ms, _ = timed(lambda: index.search(TERM, 1), 1)
+        search_ms, found = timed(
+            lambda: index.search(TERM, args.limit + 1), args.runs)
+        scan_ms, _ = timed(
+            lambda: [row for row in Post.select(Post.id)
+                     .where(Post.body.contains(TERM))
+                     .limit(args.limit + 1).tuples()], args.runs)
+        results.append({
+            "posts": size,
+            "matches": len(found),
+            "first_search_ms": round(build_ms, 2),
+            "search_ms": round(search_ms, 3),
+            "table_scan_ms": round(scan_ms, 3)
+        })
+    print(json.dumps(results, indent=2))
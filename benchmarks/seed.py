@@ -0,0 +1,211 @@
+"""
+    fill the User, Post and Post_Like tables with generated data and write
+    a request log for benchmarks/replay.py
+
+    likes follow a zipf distribution so a few hot posts get most of them,
+    authors are skewed the same way so some users have many posts
+
+    usage (SQLite, no server needed):
+        DB_ENGINE=sqlite DB_NAME=/tmp/bench.db \\
+            python benchmarks/seed.py --users 10000 --posts 100000 \\
+            --likes 1000000 --requests 10000
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import db  # noqa: E402
+from models import User, Post, PostLike, MODELS  # noqa: E402
+import backfill  # noqa: E402
+import migrate  # noqa: E402
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+
+def email(user_id):
+    return "user{}@example.com".format(user_id)
+
+
+def zipf_weights(n, skew):
+    return [1 / (rank ** skew) for rank in range(1, n + 1)]
+
+
+def chunked(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def insert(model, fields, rows, chunk_size):
+    count = 0
+    for chunk in chunked(rows, chunk_size):
+        with db.atomic():
+            model.insert_many(chunk, fields).execute()
+        count += len(chunk)
+    return count
+
+
+def gen_users(args):
+    for user_id in range(1, args.users + 1):
+        yield (user_id, email(user_id), "google",
+               "User {}".format(user_id), None, "Tester")
+
+
+def gen_posts(args, rng, start):
+    authors = rng.choices(
+        range(1, args.users + 1),
+        weights=zipf_weights(args.users, args.skew),
+        k=args.posts)
+    step = timedelta(days=args.days) / max(args.posts, 1)
+    for post_id, author in enumerate(authors, 1):
+        words = rng.randint(args.min_words, args.max_words)
+        yield (post_id,
+               " ".join(rng.choices(WORDS, k=8)).capitalize(),
+               " ".join(rng.choices(WORDS, k=words)),
+               author,
+               start + step * post_id)
+
+
+def like_counts(args, rng):
+    """
+        likes of every post adding up to --likes, zipf over a shuffled order
+        of posts so hot posts are spread in time
+        a post has at most one like per user, what the hottest posts cannot
+        take goes to the others by weight and the rounding remainders to
+        the largest fractions
+    """
+    ranks = list(range(1, args.posts + 1))
+    rng.shuffle(ranks)
+    weights = zipf_weights(args.posts, args.skew)
+    likes = min(args.likes, args.users * args.posts)
+    if likes < args.likes:
+        print("only {} likes, {} users can like {} posts once each".format(
+            likes, args.users, args.posts), file=sys.stderr)
+    # the weights go down with the rank so the capped posts come first
+    capped = 0
+    total = sum(weights)
+    while (capped < args.posts and
+           (likes - capped * args.users) * weights[capped] / total
+           >= args.users):
+        total -= weights[capped]
+        capped += 1
+    left = likes - capped * args.users
+    shares = [left * weight / total for weight in weights[capped:]]
+    counts = [args.users] * capped + [int(share) for share in shares]
+    remainders = sorted(range(len(shares)),
+                        key=lambda i: shares[i] - int(shares[i]),
+                        reverse=True)
+    for i in remainders[:left - sum(counts[capped:])]:
+        counts[capped + i] += 1
+    return {post_id: counts[rank - 1]
+            for post_id, rank in zip(range(1, args.posts + 1), ranks)}
+
+
+def gen_likes(args, rng, start, counts):
+    step = timedelta(days=args.days) / max(args.posts, 1)
+    now = start + timedelta(days=args.days)
+    like_id = 0
+    for post_id, count in counts.items():
+        if not count:
+            continue
+        created = start + step * post_id
+        span = (now - created).total_seconds()
+        for user_id in rng.sample(range(1, args.users + 1), count):
+            like_id += 1
+            yield (like_id, post_id, user_id,
+                   created + timedelta(seconds=rng.random() * span))
+
+
+def gen_requests(args, rng, counts):
+    """
+        a read heavy mix: feed pages, hot posts, author pages and likes
+    """
+    hot = sorted(counts, key=counts.get, reverse=True)[:100]
+    weights = zipf_weights(len(hot), args.skew)
+    for _ in range(args.requests):
+        user = email(rng.randint(1, args.users))
+        kind = rng.random()
+        if kind < 0.4:
+            path = "/api/posts?page={}".format(rng.randint(1, 50))
+        elif kind < 0.5:
+            path = "/api/posts?cursor=&limit=10"
+        elif kind < 0.75:
+            path = "/api/posts/{}".format(rng.choices(hot, weights)[0])
+        elif kind < 0.9:
+            path = "/api/users/{}/posts".format(
+                rng.randint(1, min(args.users, 100)))
+        else:
+            yield {"method": "POST",
+                   "path": "/api/posts/{}/likes".format(
+                       rng.randint(1, args.posts)),
+                   "email": user}
+            continue
+        yield {"method": "GET", "path": path, "email": user}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--posts", type=int, default=10000)
+    parser.add_argument("--likes", type=int, default=100000)
+    parser.add_argument("--skew", type=float, default=1.1,
+                        help="zipf exponent of likes and authors")
+    parser.add_argument("--days", type=int, default=90,
+                        help="posts are spread over the last days")
+    parser.add_argument("--min-words", type=int, default=20)
+    parser.add_argument("--max-words", type=int, default=400)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=1000,
+                        help="number of lines of the request log")
+    parser.add_argument("--requests-file",
+                        default=os.path.join(os.path.dirname(__file__),
+                                             "requests.jsonl"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--truncate", action="store_true",
+                        help="delete existing rows first")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    start = datetime.now().replace(microsecond=0) - timedelta(days=args.days)
+    migrate.migrate()
+    if args.truncate:
+        for model in reversed(MODELS):
+            model.delete().execute()
+
+    report = {}
+    began = time.perf_counter()
+    report["users"] = insert(
+        User,
+        [User.id, User.email, User.platform, User.name,
+         User.phone_number, User.occupation],
+        gen_users(args), args.chunk_size)
+    report["posts"] = insert(
+        Post,
+        [Post.id, Post.title, Post.body, Post.author, Post.created],
+        gen_posts(args, rng, start), args.chunk_size)
+    counts = like_counts(args, rng)
+    report["likes"] = insert(
+        PostLike,
+        [PostLike.id, PostLike.post_id, PostLike.user_id, PostLike.created],
+        gen_likes(args, rng, start, counts), args.chunk_size)
+    # rebuild every denormalized table from the generated rows
+    for command in backfill.commands.values():
+        command()
+    report["seconds"] = round(time.perf_counter() - began, 2)
+
+    with open(args.requests_file, "w") as f:
+        for line in gen_requests(args, rng, counts):
+            f.write(json.dumps(line) + "\n")
+    report["requests_file"] = args.requests_file
+    print(json.dumps(report))
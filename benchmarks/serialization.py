@@ -0,0 +1,93 @@
+"""
+    per post serialization cost of the read endpoints
+
+    before: likes came from the GROUP_CONCAT(json_object(...)) text, were
+    parsed with json.loads, walked by jsonable_encoder and encoded again
+    by json.dumps
+    after: rows with their recent likes are encoded once by orjson
+
+    usage: python benchmarks/serialization.py [--posts 100] [--likes 10]
+"""
+import argparse
+import json
+import timeit
+from datetime import datetime, timedelta
+import orjson
+from fastapi.encoders import jsonable_encoder
+
+
+def make_rows(posts, likes):
+    created = datetime(2022, 5, 1, 10, 0, 0)
+    rows = []
+    for i in range(posts):
+        post_likes = [{
+            "name": "user {}".format(j),
+            "created": created + timedelta(minutes=j)
+        } for j in range(likes)]
+        rows.append({
+            "id": i,
+            "author_name": "author {}".format(i % 10),
+            "title": "title {}".format(i),
+            "body": "lorem ipsum " * 50,
+            "created": created,
+            "like_count": likes,
+            "likes": post_likes,
+        })
+    return rows
+
+
+def as_group_concat(rows):
+    # what MySQL returned for the likes column of every row
+    result = []
+    for row in rows:
+        row = dict(row)
+        row["likes"] = ",".join(
+            json.dumps({"name": like["name"],
+                        "created": str(like["created"])})
+            for like in row["likes"])
+        result.append(row)
+    return result
+
+
+def before(rows):
+    posts = []
+    for post in rows:
+        post = dict(post)
+        post["likes"] = json.loads(
+            '[' + post["likes"] + ']') if post["likes"] else []
+        post["short_description"] = post["body"][:100]
+        posts.append(post)
+    return json.dumps(jsonable_encoder(posts)).encode()
+
+
+def after(rows):
+    posts = []
+    for post in rows:
+        post = dict(post)
+        post["short_description"] = post["body"][:100]
+        posts.append(post)
+    return orjson.dumps(posts)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=100)
+    parser.add_argument("--likes", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    rows = make_rows(args.posts, args.likes)
+    concat_rows = as_group_concat(rows)
+    results = {}
+    for name, func, data in (("before", before, concat_rows),
+                             ("after", after, rows)):
+        seconds = min(timeit.repeat(
+            lambda: func(data), number=args.repeat, repeat=5))
+        results[name] = seconds / args.repeat / args.posts * 1e6
+    print(json.dumps({
+        "posts": args.posts,
+        "likes_per_post": args.likes,
+        "us_per_post_before": round(results["before"], 2),
+        "us_per_post_after": round(results["after"], 2),
+        "speedup": round(results["before"] / results["after"], 1),
+    }, indent=2))
@@ -0,0 +1,106 @@
+"""
+    worker startup time: importing main and the time from starting uvicorn
+    to the first served request, exits with 1 over the budgets so it can
+    run in CI
+
+    every run is a new python process, the median of the runs is compared
+    with the budget and the modules slowest to import are listed to find
+    what made it regress
+        DB_ENGINE=sqlite DB_NAME=/tmp/bench.db \\
+            python benchmarks/startup.py --max-import-ms 800 --max-ready-ms 2000
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_MAIN = ("import time; started = time.perf_counter(); import main; "
+               "print(time.perf_counter() - started)")
+
+
+def import_ms():
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_MAIN],
+        cwd=ROOT, check=True, capture_output=True, text=True).stdout
+    return float(output.strip().splitlines()[-1]) * 1000
+
+
+def slowest_imports(top):
+    """
+        (module, cumulative ms) of the top slowest imports of main
+    """
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=ROOT, check=True, capture_output=True, text=True).stderr
+    modules = []
+    for line in stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # two spaces per level, a module is listed after what it imports
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            if name.strip() == "main":
+                break
+            modules = []
+        elif depth == 1:
+            modules.append((name.strip(), int(cumulative) / 1000))
+    modules.sort(key=lambda module: -module[1])
+    return [(name, round(ms, 1)) for name, ms in modules[:top]]
+
+
+def ready_ms(port, path):
+    """
+        from starting uvicorn to the first response of path
+    """
+    url = "http://127.0.0.1:{}{}".format(port, path)
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app",
+         "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT)
+    try:
+        while time.perf_counter() - started < 30:
+            try:
+                httpx.get(url).raise_for_status()
+                return (time.perf_counter() - started) * 1000
+            except httpx.HTTPError:
+                time.sleep(0.01)
+        raise RuntimeError("uvicorn did not start")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import-ms", type=float, default=1000)
+    parser.add_argument("--max-ready-ms", type=float, default=2500)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--path", default="/login",
+                        help="first request, a route without database")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    imports = [import_ms() for _ in range(args.runs)]
+    ready = [ready_ms(args.port, args.path) for _ in range(args.runs)]
+    report = {
+        "import_ms": round(statistics.median(imports), 1),
+        "ready_ms": round(statistics.median(ready), 1),
+        "max_import_ms": args.max_import_ms,
+        "max_ready_ms": args.max_ready_ms,
+        "slowest_imports": slowest_imports(args.top)
+    }
+    report["ok"] = (report["import_ms"] <= args.max_import_ms and
+                    report["ready_ms"] <= args.max_ready_ms)
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report["ok"] else 1)
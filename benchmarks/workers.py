@@ -0,0 +1,93 @@
+"""
+    throughput as the number of workers of serve.py grows
+
+    serve.py is started once per worker count and the same request log is
+    replayed, use a local database filled by benchmarks/seed.py
+    several workers share their caches in Redis like in production, give
+    a Redis database only used by the benchmark, it is emptied before
+    every run so each starts with a cold cache:
+        DB_ENGINE=sqlite DB_NAME=/tmp/bench.db \\
+            python benchmarks/workers.py benchmarks/requests.jsonl \\
+            --workers 1 2 4 --concurrency 50 \\
+            --cache-url redis://localhost:6379/15
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import httpx
+
+import replay
+
+
+def serve(workers, port, cache_url):
+    env = dict(os.environ,
+               WEB_CONCURRENCY=str(workers),
+               BIND="127.0.0.1:{}".format(port),
+               RESPONSE_CACHE_BACKEND="redis",
+               RESPONSE_CACHE_URL=cache_url)
+    import redis
+    redis.Redis.from_url(cache_url).flushdb()
+    process = subprocess.Popen(
+        [sys.executable, "serve.py"], cwd=replay.ROOT, env=env)
+    url = "http://127.0.0.1:{}".format(port)
+    for _ in range(300):
+        try:
+            httpx.get(url + "/login").raise_for_status()
+            # the master binds first, wait for every worker to warm up
+            time.sleep(1)
+            return process, url
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("serve.py did not start")
+
+
+def run(args, lines, workers):
+    process, url = serve(workers, args.port, args.cache_url)
+    try:
+        run_args = argparse.Namespace(
+            url=url, serve=False, timeout=args.timeout,
+            concurrency=args.concurrency)
+        total = asyncio.run(replay.run(run_args, lines))["total"]
+    finally:
+        # graceful stop, like a deploy
+        process.send_signal(signal.SIGTERM)
+        process.wait()
+    return {
+        "workers": workers,
+        "rps": total["rps"],
+        "p50_ms": total["p50_ms"],
+        "p99_ms": total["p99_ms"],
+        "errors": total["errors"]
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("requests_file")
+    parser.add_argument("--workers", type=int, nargs="+",
+                        default=[1, 2, os.cpu_count()])
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=2000,
+                        help="replay only the first lines")
+    parser.add_argument("--cache-url", required=True,
+                        help="Redis database emptied before every run")
+    parser.add_argument("--port", type=int, default=8767)
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    lines = replay.load(args.requests_file, args.limit)
+    results = [run(args, lines, workers)
+               for workers in sorted(set(args.workers))]
+    base = results[0]["rps"]
+    for result in results:
+        # 1.0 per worker is perfect scaling
+        result["speedup"] = round(result["rps"] / base, 2) if base else None
+    print(json.dumps({"cpu_count": os.cpu_count(), "results": results},
+                     indent=2))
@@ -0,0 +1,275 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+import orjson
+
+
+class TTLCache():
+    """
+        thread safe LRU cache, entries also expire ttl seconds after set
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            # drop the least recently used entries
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return item[1] if item else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        item = self._data.get(key)
+        return item is not None and item[0] >= time.monotonic()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class MemoryBackend():
+    """
+        in-process LRU storage for the response cache
+        keys are also indexed by tag so they can be dropped together
+        every invalidation is numbered, a response is not stored if one of
+        its tags was invalidated after the version its build started at
+    """
+
+    def __init__(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize, ttl)
+        self._tags = defaultdict(set)
+        self._version = 0
+        # tag -> version of its latest invalidation, oldest first
+        self._versions = OrderedDict()
+        # newest version forgotten from _versions
+        self._forgotten = 0
+        # tag -> time until responses read on a replica are not stored
+        self._held = {}
+        self._lock = threading.Lock()
+        self._sets = 0
+
+    def version(self):
+        return self._version
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value, tags, replica=False, since=None):
+        with self._lock:
+            if since is not None and self._changed(tags, since):
+                return
+            if replica and self._is_held(tags):
+                return
+            self._cache.set(key, value)
+            for tag in tags:
+                self._tags[tag].add(key)
+            self._sets += 1
+            if self._sets >= self._cache.maxsize:
+                self._sweep()
+
+    def _changed(self, tags, since):
+        if since < self._forgotten:
+            return True
+        return any(self._versions.get(tag, 0) > since for tag in tags)
+
+    def _is_held(self, tags):
+        now = time.monotonic()
+        return any(self._held.get(tag, 0) > now for tag in tags)
+
+    def _sweep(self):
+        # forget the keys the LRU already evicted or expired
+        self._sets = 0
+        for tag in list(self._tags):
+            keys = {key for key in self._tags[tag] if key in self._cache}
+            if keys:
+                self._tags[tag] = keys
+            else:
+                del self._tags[tag]
+
+    def invalidate(self, tags, hold=0):
+        with self._lock:
+            self._version += 1
+            for tag in tags:
+                self._versions[tag] = self._version
+                self._versions.move_to_end(tag)
+            while len(self._versions) > self._cache.maxsize:
+                self._forgotten = self._versions.popitem(last=False)[1]
+            if hold:
+                now = time.monotonic()
+                if len(self._held) >= self._cache.maxsize:
+                    self._held = {tag: until for tag, until
+                                  in self._held.items() if until > now}
+                for tag in tags:
+                    self._held[tag] = now + hold
+            keys = set()
+            for tag in tags:
+                keys |= self._tags.pop(tag, set())
+            for key in keys:
+                self._cache.pop(key)
+
+
+class RedisBackend():
+    """
+        response cache storage in a Redis compatible server
+        shared by all workers, tags are kept as sets of keys
+    """
+
+    def __init__(self, url, ttl):
+        # optional dependency, only needed with this backend
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._watch_error = redis.WatchError
+        self.ttl = ttl
+
+    def ttl_cache(self, prefix, ttl):
+        """
+            a TTLCache kept in the same server, for state every worker must
+            see
+        """
+        return RedisTTLCache(self._redis, prefix, ttl)
+
+    def version(self):
+        return int(self._redis.get("version") or 0)
+
+    def get(self, key):
+        return self._redis.get(key)
+
+    def set(self, key, value, tags, replica=False, since=None):
+        with self._redis.pipeline() as pipe:
+            try:
+                versions = (["version:" + tag for tag in tags]
+                            if since is not None else [])
+                held = ["held:" + tag for tag in tags] if replica else []
+                if versions or held:
+                    # an invalidation between the check and the write fails
+                    # the transaction
+                    pipe.watch(*versions, *held)
+                    values = pipe.mget(versions + held)
+                    if any(int(version) > since for version
+                           in values[:len(versions)] if version):
+                        return
+                    if any(values[len(versions):]):
+                        return
+                pipe.multi()
+                pipe.set(key, value, ex=self.ttl)
+                for tag in tags:
+                    pipe.sadd("tag:" + tag, key)
+                    pipe.expire("tag:" + tag, self.ttl)
+                pipe.execute()
+            except self._watch_error:
+                pass
+
+    def invalidate(self, tags, hold=0):
+        if not tags:
+            return
+        version = self._redis.incr("version")
+        pipe = self._redis.pipeline()
+        for tag in tags:
+            pipe.set("version:" + tag, version, ex=self.ttl)
+            if hold:
+                pipe.set("held:" + tag, 1, px=int(hold * 1000))
+        for tag in tags:
+            pipe.smembers("tag:" + tag)
+        keys = set().union(*pipe.execute()[-len(tags):])
+        pipe = self._redis.pipeline()
+        if keys:
+            pipe.delete(*keys)
+        pipe.delete(*["tag:" + tag for tag in tags])
+        pipe.execute()
+
+
+class RedisTTLCache():
+    """
+        get, set and pop of TTLCache over Redis, values are stored as json
+        entries expire ttl seconds after set, there is no LRU
+    """
+
+    def __init__(self, redis, prefix, ttl):
+        self._redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        value = self._redis.get(self.prefix + str(key))
+        return default if value is None else orjson.loads(value)
+
+    def set(self, key, value):
+        self._redis.set(self.prefix + str(key), orjson.dumps(value),
+                        px=int(self.ttl * 1000))
+
+    def pop(self, key):
+        pipe = self._redis.pipeline()
+        pipe.get(self.prefix + str(key))
+        pipe.delete(self.prefix + str(key))
+        value = pipe.execute()[0]
+        return None if value is None else orjson.loads(value)
+
+    def __contains__(self, key):
+        return bool(self._redis.exists(self.prefix + str(key)))
+
+
+class ResponseCache():
+    """
+        serialized responses with their ETag
+        writes invalidate the tags of the data they change
+        for hold seconds after, responses read on a replica are not stored
+        for these tags, the replica may not have the write yet
+        read the version before building a response and pass it to set, it
+        is not stored if a write invalidated it in the meantime
+    """
+
+    def __init__(self, backend, hold=0):
+        self.backend = backend
+        self.hold = hold
+
+    def version(self):
+        return self.backend.version()
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            return None
+        etag, body = value.split(b"\n", 1)
+        return etag.decode(), body
+
+    def entry(self, body):
+        """
+            (etag, body) of a response, without storing it
+        """
+        return '"{}"'.format(hashlib.sha1(body).hexdigest()), body
+
+    def set(self, key, body, tags, replica=False, since=None):
+        etag, body = self.entry(body)
+        self.backend.set(
+            key, etag.encode() + b"\n" + body, tags, replica, since)
+        return etag, body
+
+    def invalidate(self, *tags):
+        self.backend.invalidate(tags, self.hold)
@@ -1,16 +1,45 @@
 import peewee
 from dotenv import load_dotenv
 from contextvars import ContextVar
+from fastapi import Depends, Request
+from playhouse.pool import PooledMySQLDatabase, MaxConnectionsExceeded
+from starlette.concurrency import run_in_threadpool
+from cache import TTLCache
+import itertools
+import logging
+import threading
 import os
+import time
 
+# the only load_dotenv of the app, every module reading .env imports this
+# one first (serve.py loads it too, for the gunicorn master)
 load_dotenv()
 _env = os.getenv
 
+# mysql, or sqlite (DB_NAME is then the file) for tests and benchmarks
+DB_ENGINE = _env("DB_ENGINE", "mysql")
 DB_NAME = _env('DB_NAME')
 DB_USER = _env("DB_USER")
 DB_PW = _env("DB_PW")
 DB_HOST = _env("DB_HOST")
-DB_PORT = int(_env("DB_PORT"))
+DB_PORT = int(_env("DB_PORT", 3306))
+DB_POOL = _env("DB_POOL", "false").lower() in ("1", "true", "yes")
+DB_POOL_MAX_SIZE = int(_env("DB_POOL_MAX_SIZE", 20))
+DB_POOL_STALE_TIMEOUT = int(_env("DB_POOL_STALE_TIMEOUT", 300))
+DB_POOL_WAIT_TIMEOUT = int(_env("DB_POOL_WAIT_TIMEOUT", 10))
+# read replicas, "host" or "host:port" (files for sqlite), comma separated
+DB_REPLICAS = [replica.strip()
+               for replica in _env("DB_REPLICAS", "").split(",")
+               if replica.strip()]
+# a user who wrote reads from the primary for this many seconds, longer than
+# the replication lag so they see their own writes
+DB_REPLICA_STICKY_SECONDS = float(_env("DB_REPLICA_STICKY_SECONDS", 5))
+# a replica that failed is skipped for this many seconds
+DB_REPLICA_RETRY_SECONDS = float(_env("DB_REPLICA_RETRY_SECONDS", 10))
+# log statements slower than this many milliseconds, 0 to disable
+SLOW_QUERY_MS = float(_env("SLOW_QUERY_MS", 0))
+
+slow_query_log = logging.getLogger("slow_query")
 
 db_state_default = {
     "closed": None,
@@ -21,8 +50,8 @@ db_state = ContextVar("db_state", default=db_state_default.copy())
 
 
 class PeeweeConnectionState(peewee._ConnectionState):
-    def __init__(self, **kwargs):
-        super().__setattr__("_state", db_state)
+    def __init__(self, state=db_state, **kwargs):
+        super().__setattr__("_state", state)
         super().__init__(**kwargs)
 
     def __setattr__(self, name, value):
@@ -32,12 +61,350 @@ class PeeweeConnectionState(peewee._ConnectionState):
         return self._state.get()[name]
 
 
-db = peewee.MySQLDatabase(
-    DB_NAME,
-    user=DB_USER,
-    password=DB_PW,
-    host=DB_HOST,
-    port=DB_PORT
-)
+class QueryStats():
+    """
+        queries run while serving one request
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0
+        self.slowest = 0
+        self.slowest_sql = None
+
+    def record(self, sql, seconds):
+        self.count += 1
+        self.seconds += seconds
+        if seconds > self.slowest:
+            self.slowest = seconds
+            self.slowest_sql = sql
+
+
+# set by the metrics middleware, a mutable object so the threadpool copies
+# of the request context add to the same stats
+query_stats = ContextVar("query_stats", default=None)
+
+
+def record_query(sql, params, seconds):
+    """
+        add a statement to the stats of the request, log it if it is slow
+    """
+    stats = query_stats.get()
+    if stats is not None:
+        stats.record(sql, seconds)
+    if SLOW_QUERY_MS and seconds * 1000 >= SLOW_QUERY_MS:
+        slow_query_log.warning("%.1f ms: %s %r", seconds * 1000, sql, params)
+
+
+class QueryStatsMixin():
+    """
+        time every statement and add it to the stats of the request
+    """
+
+    def execute_sql(self, sql, params=None, commit=peewee.SENTINEL):
+        started = time.perf_counter()
+        try:
+            return super().execute_sql(sql, params, commit)
+        finally:
+            record_query(sql, params, time.perf_counter() - started)
+
+
+# the replica picked for the request, set by the use_replica dependency of
+# the read only endpoints
+read_replica = ContextVar("read_replica", default=None)
+
+
+class ReplicaRoutingMixin():
+    """
+        send the SELECTs outside of transactions to the replica of the
+        request, back to the primary when the replica fails
+    """
+    replicas = None
+
+    def execute_sql(self, sql, params=None, commit=peewee.SENTINEL):
+        # replicas have no replicas, they run what they are sent
+        replica = read_replica.get() if self.replicas else None
+        if replica is not None and not self.in_transaction() and \
+                sql.lstrip()[:6].upper() == "SELECT":
+            try:
+                return replica.execute_sql(sql, params, commit)
+            except (peewee.OperationalError, peewee.InterfaceError):
+                self.replicas.failed(replica)
+                read_replica.set(None)
+        return super().execute_sql(sql, params, commit)
+
+
+class MySQLDatabase(
+        ReplicaRoutingMixin, QueryStatsMixin, peewee.MySQLDatabase):
+    pass
+
+
+class SqliteDatabase(
+        ReplicaRoutingMixin, QueryStatsMixin, peewee.SqliteDatabase):
+    pass
+
+
+class StatsPooledMySQLDatabase(
+        ReplicaRoutingMixin, QueryStatsMixin, PooledMySQLDatabase):
+    """
+        connection pool that also counts the checkouts which had to wait
+        for a connection to be returned
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._waits = 0
+        super().__init__(*args, **kwargs)
+
+    def connect(self, reuse_if_open=False):
+        try:
+            # try once without the wait loop of the pool
+            return peewee.MySQLDatabase.connect(self, reuse_if_open)
+        except MaxConnectionsExceeded:
+            if not self._wait_timeout:
+                raise
+        with self._lock:
+            self._waits += 1
+        return super().connect(reuse_if_open)
+
+    def stats(self):
+        return {
+            "max_size": self._max_connections,
+            "in_use": len(self._in_use),
+            "idle": len(self._connections),
+            "waits": self._waits
+        }
+
+
+class Replicas():
+    """
+        read replicas picked round-robin
+        a replica is taken out when a query fails on it and tried again
+        after DB_REPLICA_RETRY_SECONDS, check pings them all in between
+    """
+
+    def __init__(self, databases, sticky_seconds, retry_seconds):
+        self.databases = databases
+        self.retry_seconds = retry_seconds
+        self._counter = itertools.count()
+        self._down = {}
+        self._lock = threading.Lock()
+        # users who wrote recently, they read from the primary
+        # replaced by a shared cache when there are several workers
+        self.writers = TTLCache(100000, sticky_seconds)
+
+    def pick(self):
+        now = time.monotonic()
+        with self._lock:
+            healthy = [database for database in self.databases
+                       if self._down.get(database, 0) <= now]
+        if not healthy:
+            return None
+        return healthy[next(self._counter) % len(healthy)]
+
+    def failed(self, database):
+        with self._lock:
+            self._down[database] = time.monotonic() + self.retry_seconds
+        try:
+            if not database.is_closed():
+                database.close()
+        except peewee.DatabaseError:
+            pass
+
+    def wrote(self, user_id):
+        self.writers.set(user_id, True)
+
+    def is_sticky(self, user_id):
+        return user_id in self.writers
+
+    def check(self):
+        """
+            ping every replica, one that answers is used again at once and
+            one that does not is taken out before a request fails on it
+            the caller sets a fresh connection state
+        """
+        for database in self.databases:
+            try:
+                with database.connection_context():
+                    database.execute_sql("SELECT 1")
+            except (peewee.OperationalError, peewee.InterfaceError):
+                self.failed(database)
+            else:
+                with self._lock:
+                    self._down.pop(database, None)
+
+    def health(self):
+        now = time.monotonic()
+        return [{"replica": replica_name(database),
+                 "healthy": self._down.get(database, 0) <= now}
+                for database in self.databases]
+
+
+def replica_name(database):
+    """
+        host:port of a MySQL replica, the file of a SQLite one
+    """
+    params = database.connect_params
+    if "host" not in params:
+        return database.database
+    return "{}:{}".format(params["host"], params.get("port", DB_PORT))
+
+
+def connect(name, host=DB_HOST, port=DB_PORT, state=db_state):
+    """
+        database object of DB_ENGINE, with its connection kept per request
+    """
+    if DB_ENGINE == "sqlite":
+        database = SqliteDatabase(
+            name,
+            pragmas={"journal_mode": "wal"},
+            # the connection of a request is used by several threadpool
+            # threads
+            check_same_thread=False
+        )
+    elif DB_POOL:
+        database = StatsPooledMySQLDatabase(
+            name,
+            max_connections=DB_POOL_MAX_SIZE,
+            stale_timeout=DB_POOL_STALE_TIMEOUT,
+            timeout=DB_POOL_WAIT_TIMEOUT,
+            user=DB_USER,
+            password=DB_PW,
+            host=host,
+            port=port
+        )
+    else:
+        database = MySQLDatabase(
+            name,
+            user=DB_USER,
+            password=DB_PW,
+            host=host,
+            port=port
+        )
+    database._state = PeeweeConnectionState(state)
+    return database
+
+
+def connect_replica(index, replica):
+    state = ContextVar(
+        "replica_state_{}".format(index), default=db_state_default.copy())
+    if DB_ENGINE == "sqlite":
+        return connect(replica, state=state)
+    host, _, port = replica.partition(":")
+    return connect(DB_NAME, host, int(port or DB_PORT), state)
+
+
+db = connect(DB_NAME)
+replicas = None
+if DB_REPLICAS:
+    replicas = Replicas(
+        [connect_replica(index, replica)
+         for index, replica in enumerate(DB_REPLICAS)],
+        DB_REPLICA_STICKY_SECONDS,
+        DB_REPLICA_RETRY_SECONDS)
+    db.replicas = replicas
+
+
+def databases():
+    return [db] + (replicas.databases if replicas else [])
+
+
+def close_all():
+    """
+        close the idle connections of the pools, when the worker stops
+    """
+    for database in databases():
+        if isinstance(database, PooledMySQLDatabase):
+            database.close_all()
+
+
+def pool_stats():
+    """
+        in use / idle connections and waits of the pool, None without pool
+    """
+    if not isinstance(db, StatsPooledMySQLDatabase):
+        return None
+    return db.stats()
+
+
+def conflict_target(*fields):
+    """
+        MySQL finds the key of ON DUPLICATE KEY UPDATE by itself and
+        refuses a target, other databases need the conflicting columns
+    """
+    if isinstance(db, peewee.MySQLDatabase):
+        return None
+    return list(fields)
+
+
+def excluded(field):
+    """
+        in ON DUPLICATE KEY UPDATE, the value the insert wanted to write:
+        VALUES(column) in MySQL, EXCLUDED.column in other databases
+    """
+    if isinstance(db, peewee.MySQLDatabase):
+        return peewee.fn.VALUES(field)
+    return getattr(peewee.EXCLUDED, field.column_name)
+
+
+def first_insert_id(cursor, rows):
+    """
+        id of the first row of a multi-row INSERT, MySQL reports it as
+        lastrowid, SQLite the id of the last row
+    """
+    if isinstance(db, peewee.MySQLDatabase):
+        return cursor.lastrowid
+    return cursor.lastrowid - rows + 1
+
+
+def greatest(*values):
+    # GREATEST in MySQL, the scalar (more than one argument) MAX in SQLite
+    if isinstance(db, peewee.MySQLDatabase):
+        return peewee.fn.GREATEST(*values)
+    return peewee.fn.MAX(*values)
+
+
+async def reset_db_state():
+    # async so the fresh state is set in the request context itself and
+    # is shared with the threadpool that runs the sync dependencies
+    for database in databases():
+        database._state._state.set(db_state_default.copy())
+        database._state.reset()
+    read_replica.set(None)
+
+
+def get_db(db_state=Depends(reset_db_state)):
+    """
+        give back the connection of the request when it is done
+        the connection is only opened (or checked out of the pool) by the
+        first query, so requests served from cache never touch the database
+    """
+    try:
+        yield
+    finally:
+        for database in databases():
+            if not database.is_closed():
+                database.close()
+
+
+async def use_replica(request: Request):
+    """
+        dependency of the read only endpoints, after the authentication:
+        their SELECTs go to a replica unless the user wrote recently
+        async for the same reason as reset_db_state
+    """
+    if replicas is None:
+        return
+    user = getattr(request.state, "user", None)
+    # the sticky set may be in Redis, a blocking call
+    if user and await run_in_threadpool(replicas.is_sticky, user["id"]):
+        return
+    read_replica.set(replicas.pick())
+
 
-db._state = PeeweeConnectionState()
+def mark_write(user_id):
+    """
+        keep the reads of the user on the primary until the replicas
+        have the write
+    """
+    if replicas is not None:
+        replicas.wrote(user_id)
@@ -1,26 +1,638 @@
+import base64
+import json
+import math
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from database import (
+    db, conflict_target, excluded, first_insert_id, greatest
+)
 from models import (
-    User, PostLike
+    User, Post, PostLike, PostStats, PostRecentLike, PostTrending, UserStats
+)
+from peewee import (
+    chunked, fn, EXCLUDED, JOIN, MySQLDatabase, Select, Tuple, Value
 )
-from peewee import fn
+
+# number of latest likes kept inline for every post
+RECENT_LIKES = int(os.getenv("RECENT_LIKES", 10))
+# a like counts half as much for trending after this many hours
+TRENDING_HALF_LIFE_HOURS = float(os.getenv("TRENDING_HALF_LIFE_HOURS", 24))
+# a new post counts as this many likes
+TRENDING_POST_WEIGHT = float(os.getenv("TRENDING_POST_WEIGHT", 1))
+# posts whose score decayed below 2^-TRENDING_MAX_HALF_LIVES likes are dropped
+TRENDING_MAX_HALF_LIVES = float(os.getenv("TRENDING_MAX_HALF_LIVES", 10))
+TRENDING_EPOCH = datetime(2022, 1, 1)
+
+
+# fields of a post in the responses, id and created are always returned
+POST_FIELDS = ["id", "author_id", "author_name", "title", "body",
+               "short_description", "created", "like_count", "likes"]
+# list endpoints leave out the body unless it is asked for
+PREVIEW_FIELDS = [field for field in POST_FIELDS if field != "body"]
+SHORT_DESCRIPTION_LENGTH = 100
+
+
+def get_posts_query(fields=POST_FIELDS):
+    """
+        get query for posts with author name and like count
+        the like count is read from the Post_Stats projection
+        only the columns of the given fields are selected, the short
+        description is cut by the database so the body is not read
+        the author id comes with the author name, the response cache
+        drops the posts when the name changes
+    """
+    if "author_name" in fields and "author_id" not in fields:
+        fields = ["author_id"] + list(fields)
+    columns = {
+        "id": Post.id,
+        "author_id": Post.author.alias("author_id"),
+        "author_name": User.name.alias("author_name"),
+        "title": Post.title,
+        "body": Post.body,
+        "short_description": fn.SUBSTR(
+            Post.body, 1, SHORT_DESCRIPTION_LENGTH).alias("short_description"),
+        "created": Post.created,
+        "like_count": fn.COALESCE(PostStats.like_count, 0).alias("like_count")
+    }
+    return (
+        Post.select(*[column for name, column in columns.items()
+                      if name in fields or name in ("id", "created")])
+        .join(User, on=Post.author == User.id)
+        .switch(Post)
+        .join(PostStats, JOIN.LEFT_OUTER, on=PostStats.post_id == Post.id))
+
+
+def parse_fields(fields=None, include=None, likes=None):
+    """
+        fields of the posts of a list endpoint from its query parameters
+        `fields` picks them, `include=body` adds the body to the preview
+        and `likes=count` keeps the like count but not the likes list
+        raise ValueError on an unknown field
+    """
+    if fields:
+        selected = [field.strip() for field in fields.split(",")]
+    else:
+        selected = list(PREVIEW_FIELDS)
+    if include:
+        selected += [field.strip() for field in include.split(",")]
+    if likes == "count":
+        selected = [field for field in selected if field != "likes"]
+    elif likes:
+        raise ValueError("Invalid likes")
+    unknown = set(selected) - set(POST_FIELDS)
+    if unknown:
+        raise ValueError("Unknown fields: " + ", ".join(sorted(unknown)))
+    return [field for field in POST_FIELDS
+            if field in selected or field in ("id", "created")]
+
+
+def after_cursor(cursor):
+    """
+        keyset condition to seek to the first post after the cursor
+        posts are ordered by (created, id) so the id breaks ties
+    """
+    return after_post(*decode_cursor(cursor))
+
+
+def after_post(created, post_id):
+    return ((Post.created > created) |
+            ((Post.created == created) & (Post.id > post_id)))
+
+
+def encode_cursor(created, post_id):
+    """
+        build an opaque cursor from the (created, id) of the last post of a page
+    """
+    return _encode_values([created.isoformat(), post_id])
+
+
+def decode_cursor(cursor):
+    """
+        reverse encode_cursor, raise ValueError if the cursor is malformed
+    """
+    created, post_id = _decode_values(cursor)
+    try:
+        return datetime.fromisoformat(created), int(post_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def encode_rank_cursor(score, post_id):
+    """
+        cursor of ranked results, from the (score, id) of the last one
+    """
+    return _encode_values([score, post_id])
+
+
+def decode_rank_cursor(cursor):
+    score, post_id = _decode_values(cursor)
+    try:
+        return float(score), int(post_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def _encode_values(values):
+    raw = json.dumps(values).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_values(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+        if not isinstance(values, list) or len(values) != 2:
+            raise ValueError("Invalid cursor")
+        return values
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
 
 
-def get_likes_subquery():
+def get_recent_likes_query(post_ids):
     """
-        get subquery for all post with author name and like time sorted descending
-        so that the last like show first
+        get query for the latest likes of the given posts with liker name
+        likes are read from the Post_Recent_Like projection, newest first
+    """
+    return (
+        PostRecentLike.select(
+            PostRecentLike.post_id,
+            PostRecentLike.user_id,
+            User.name,
+            PostRecentLike.created) .join(
+            User,
+            on=User.id == PostRecentLike.user_id) .where(
+                PostRecentLike.post_id.in_(post_ids)) .order_by(
+                    PostRecentLike.created.desc(),
+                    PostRecentLike.id.desc()))
+
+
+def get_likes_query(post_id):
+    """
+        get query for all likes of a post with liker name, newest first
+        served by the (post_id, created) index of Post_Like
     """
-    UserAlias = User.alias()
     return (
         PostLike.select(
-            PostLike.post_id,
-            fn.GROUP_CONCAT(
-                fn.json_object(
-                    "name",
-                    UserAlias.name,
-                    "created",
-                    PostLike.created)) .order_by(
-                PostLike.created.desc()) .alias("likes"),
-        ) .join(
-            UserAlias,
-            on=UserAlias.id == PostLike.user_id) .group_by(
-            PostLike.post_id))
+            PostLike.id,
+            PostLike.user_id,
+            User.name,
+            PostLike.created)
+        .join(User, on=User.id == PostLike.user_id)
+        .where(PostLike.post_id == post_id)
+        .order_by(PostLike.created.desc(), PostLike.id.desc()))
+
+
+def before_like(created, like_id):
+    """
+        keyset condition to seek to the first like older than (created, id)
+    """
+    return ((PostLike.created < created) |
+            ((PostLike.created == created) & (PostLike.id < like_id)))
+
+
+def attach_likes(posts, fields=POST_FIELDS):
+    """
+        add the latest likes to the given posts if they are in the fields
+    """
+    if "likes" not in fields:
+        return posts
+    post_ids = [post["id"] for post in posts]
+    likes = defaultdict(list)
+    if post_ids:
+        for like in get_recent_likes_query(post_ids).dicts():
+            likes[like.pop("post_id")].append(like)
+    for post in posts:
+        post["likes"] = likes.get(post["id"], [])
+    return posts
+
+
+def iter_posts(query, batch_size, fields=POST_FIELDS):
+    """
+        iterate the posts of the query ordered by (created, id) with likes
+        rows are read by keyset batches so only one batch is in memory
+    """
+    last = None
+    while True:
+        batch = query.order_by(Post.created, Post.id)
+        if last:
+            batch = batch.where(after_post(last["created"], last["id"]))
+        batch = [post for post in batch.limit(batch_size).dicts()]
+        yield from attach_likes(batch, fields)
+        if len(batch) < batch_size:
+            return
+        last = batch[-1]
+
+
+def insert_posts(posts, author, chunk_size):
+    """
+        insert the (title, body) posts of an author with multi-row INSERTs
+        of chunk_size posts, in the transaction of the caller
+        returns the ids of the new posts in order
+        the ids are read back by author, so concurrent inserts of the same
+        author have to wait for the transaction (see create_posts)
+    """
+    post_ids = []
+    for chunk in chunked(posts, chunk_size):
+        cursor = db.execute(Post.insert_many(
+            [(title, body, author) for title, body in chunk],
+            [Post.title, Post.body, Post.author]))
+        # ids of other authors' concurrent inserts may come in between
+        ids = (Post.select(Post.id)
+               .where((Post.author == author) &
+                      (Post.id >= first_insert_id(cursor, len(chunk))))
+               .order_by(Post.id)
+               .limit(len(chunk))
+               .tuples())
+        post_ids += [post_id for post_id, in ids]
+    return post_ids
+
+
+def insert_likes_query(post_ids, user_id):
+    """
+        like the given posts with a single INSERT IGNORE ... SELECT
+        missing posts are skipped by the SELECT and existing likes by
+        UK_post_user, the cursor rowcount is the number of new likes
+    """
+    return (PostLike.insert_from(
+        Post.select(Post.id, Value(user_id)).where(Post.id.in_(post_ids)),
+        [PostLike.post_id, PostLike.user_id])
+        .on_conflict_ignore())
+
+
+def insert_likes(post_ids, user_id):
+    return db.execute(insert_likes_query(post_ids, user_id))
+
+
+def record_likes_queries(post_ids, user_id):
+    """
+        the statements updating the like projections after new Post_Like
+        rows were written, in order
+    """
+    return [
+        (PostStats.insert_many(
+            [(post_id, 1) for post_id in post_ids],
+            [PostStats.post_id, PostStats.like_count])
+            .on_conflict(
+                conflict_target=conflict_target(PostStats.post_id),
+                update={PostStats.like_count: PostStats.like_count + 1})),
+        # copy the rows so both tables share the same created time
+        (PostRecentLike.insert_from(
+            PostLike.select(
+                PostLike.post_id,
+                PostLike.user_id,
+                PostLike.created)
+            .where(PostLike.post_id.in_(post_ids))
+            .where(PostLike.user_id == user_id),
+            [PostRecentLike.post_id,
+             PostRecentLike.user_id,
+             PostRecentLike.created])),
+        *[trim_recent_likes_query(post_id) for post_id in post_ids],
+        bump_trending_query(post_ids),
+        count_received_likes_query(post_ids)
+    ]
+
+
+def record_likes(post_ids, user_id):
+    """
+        update the like projections after new Post_Like rows were written
+        should run in the same transaction as the insert
+    """
+    for query in record_likes_queries(post_ids, user_id):
+        query.execute()
+
+
+def add_like(post_id, user_id):
+    """
+        like a post and update the projections in one transaction
+        return the id of the like, None if the post does not exist or is
+        already liked
+    """
+    with db.atomic():
+        cursor = insert_likes([post_id], user_id)
+        if not cursor.rowcount:
+            return None
+        # keep like count and latest likes up to date for the read endpoints
+        record_likes([post_id], user_id)
+    return cursor.lastrowid
+
+
+def get_liked_posts_query(post_ids, user_id):
+    """
+        get query for the given posts that exist with the id of the like
+        of the user, like_id is NULL if the user did not like the post
+    """
+    return (Post.select(Post.id, PostLike.id.alias("like_id"))
+                .join(
+                    PostLike,
+                    JOIN.LEFT_OUTER,
+                    on=((PostLike.post_id == Post.id) &
+                        (PostLike.user_id == user_id)))
+                .where(Post.id.in_(post_ids)))
+
+
+def trim_recent_likes_query(post_id):
+    """
+        only keep the newest RECENT_LIKES rows of the post: delete the rows
+        up to the first one past them, found with LIMIT instead of a window
+        function so MySQL 5.7 runs it
+    """
+    # the derived table is materialized first, so MySQL accepts deleting
+    # from the table it reads
+    cutoff = (PostRecentLike.select(PostRecentLike.created, PostRecentLike.id)
+              .where(PostRecentLike.post_id == post_id)
+              .order_by(PostRecentLike.created.desc(),
+                        PostRecentLike.id.desc())
+              .limit(1)
+              .offset(RECENT_LIKES)
+              .alias("cutoff"))
+    return (PostRecentLike.delete()
+                          .where(PostRecentLike.post_id == post_id)
+                          .where(Tuple(PostRecentLike.created,
+                                       PostRecentLike.id) <=
+                                 Select([cutoff],
+                                        [cutoff.c.created, cutoff.c.id])))
+
+
+def trim_recent_likes(post_ids):
+    for post_id in post_ids:
+        trim_recent_likes_query(post_id).execute()
+
+
+def get_newest_likes_query(post_id):
+    """
+        get query for the newest RECENT_LIKES likes of the post, oldest
+        first, served by the (post_id, created) index of Post_Like
+    """
+    newest = (PostLike.select(
+        PostLike.id,
+        PostLike.post_id,
+        PostLike.user_id,
+        PostLike.created)
+        .where(PostLike.post_id == post_id)
+        .order_by(PostLike.created.desc(), PostLike.id.desc())
+        .limit(RECENT_LIKES)
+        .alias("newest"))
+    return (Select([newest],
+                   [newest.c.post_id, newest.c.user_id, newest.c.created])
+            .order_by(newest.c.created, newest.c.id)
+            .bind(db))
+
+
+def rebuild_like_projections():
+    """
+        recompute Post_Stats and Post_Recent_Like from Post_Like
+        used to backfill the projections or repair them after drift
+    """
+    with db.atomic():
+        PostStats.delete().execute()
+        (PostStats.insert_from(
+            PostLike.select(
+                PostLike.post_id,
+                fn.COUNT(PostLike.id))
+            .group_by(PostLike.post_id),
+            [PostStats.post_id, PostStats.like_count])
+            .execute())
+
+        PostRecentLike.delete().execute()
+        # a statement per post, without window functions for MySQL 5.7
+        post_ids = [post_id for post_id, in PostLike.select(PostLike.post_id)
+                    .distinct()
+                    .tuples()]
+        for post_id in post_ids:
+            (PostRecentLike.insert_from(
+                get_newest_likes_query(post_id),
+                [PostRecentLike.post_id,
+                 PostRecentLike.user_id,
+                 PostRecentLike.created])
+                .execute())
+
+
+def upsert_user_stats(query):
+    """
+        add the counts of the rows the query inserts into User_Stats to the
+        existing rows
+    """
+    return query.on_conflict(
+        conflict_target=conflict_target(UserStats.user_id),
+        update={
+            UserStats.post_count: (
+                UserStats.post_count + excluded(UserStats.post_count)),
+            UserStats.like_count: (
+                UserStats.like_count + excluded(UserStats.like_count)),
+            UserStats.last_post_at: fn.COALESCE(
+                excluded(UserStats.last_post_at), UserStats.last_post_at)
+        })
+
+
+def count_posts_query(author, count):
+    """
+        add new posts of the author to User_Stats
+        the latest post time is read from the (author, created) index
+    """
+    return upsert_user_stats(UserStats.insert(
+        user_id=author,
+        post_count=count,
+        like_count=0,
+        last_post_at=(Post.select(fn.MAX(Post.created))
+                      .where(Post.author == author))))
+
+
+def count_posts(author, count):
+    count_posts_query(author, count).execute()
+
+
+def count_received_likes_query(post_ids):
+    """
+        add a new like of every post to the like count of its author
+    """
+    return upsert_user_stats(UserStats.insert_from(
+        Post.select(
+            Post.author,
+            Value(0),
+            fn.COUNT(Post.id),
+            Value(None))
+        .where(Post.id.in_(post_ids))
+        .group_by(Post.author),
+        [UserStats.user_id, UserStats.post_count, UserStats.like_count,
+         UserStats.last_post_at]))
+
+
+def get_user_summary_query(user_id):
+    """
+        get query for the profile of a user with the counters of User_Stats
+    """
+    return (User.select(
+                User.id,
+                User.name,
+                User.occupation,
+                fn.COALESCE(UserStats.post_count, 0).alias("post_count"),
+                fn.COALESCE(UserStats.like_count, 0).alias("like_count"),
+                UserStats.last_post_at)
+            .join(UserStats, JOIN.LEFT_OUTER,
+                  on=(UserStats.user_id == User.id))
+            .where(User.id == user_id))
+
+
+def rebuild_user_stats():
+    """
+        recompute User_Stats from Post and Post_Like
+        used to backfill the table or repair it after drift
+    """
+    likes = (Post.select(
+                 Post.author.alias("author"),
+                 fn.COUNT(PostLike.id).alias("like_count"))
+             .join(PostLike, on=(PostLike.post_id == Post.id))
+             .group_by(Post.author)
+             .alias("likes"))
+    with db.atomic():
+        UserStats.delete().execute()
+        (UserStats.insert_from(
+            Post.select(
+                Post.author,
+                fn.COUNT(Post.id),
+                fn.COALESCE(likes.c.like_count, 0),
+                fn.MAX(Post.created))
+            .join(likes, JOIN.LEFT_OUTER,
+                  on=(likes.c.author == Post.author))
+            .group_by(Post.author, likes.c.like_count),
+            [UserStats.user_id, UserStats.post_count, UserStats.like_count,
+             UserStats.last_post_at])
+            .execute())
+
+
+def half_lives(time, since=TRENDING_EPOCH):
+    """
+        trending half lives between since (the epoch) and the given time
+    """
+    seconds = (time - since).total_seconds()
+    return seconds / 3600 / TRENDING_HALF_LIFE_HOURS
+
+
+def bump_trending_query(post_ids, weight=1):
+    """
+        add weight to the trending score of the posts
+        a score is log2 of the sum of weight * 2^(half lives since the epoch)
+        of every like, so older likes count less without ever updating
+        the rows again and ordering by score is ordering by decayed score
+        the sum is kept in log space so it never overflows
+    """
+    score = half_lives(datetime.now()) + math.log2(weight)
+    # log2(2^a + 2^b) = max(a, b) + log2(1 + 0.5^|a - b|)
+    return (PostTrending.insert_many(
+        [(post_id, score) for post_id in post_ids],
+        [PostTrending.post_id, PostTrending.score])
+        .on_conflict(
+            conflict_target=conflict_target(PostTrending.post_id),
+            update={PostTrending.score: (
+                greatest(PostTrending.score, score) +
+                fn.LOG2(1 + fn.POW(0.5, fn.ABS(PostTrending.score - score))))}))
+
+
+def bump_trending(post_ids, weight=1):
+    bump_trending_query(post_ids, weight).execute()
+
+
+def get_trending_query(limit):
+    """
+        get query for the ids and scores of the top trending posts
+        read from the score index, only limit rows are visited
+    """
+    return (PostTrending.select(PostTrending.post_id, PostTrending.score)
+                        .order_by(PostTrending.score.desc(),
+                                  PostTrending.post_id.desc())
+                        .limit(limit))
+
+
+def decayed_score(score):
+    """
+        trending score as the number of likes given right now it is worth
+    """
+    return 2 ** (score - half_lives(datetime.now()))
+
+
+def prune_trending():
+    """
+        drop the posts whose likes all decayed, keeps the table small
+    """
+    return (PostTrending.delete()
+                        .where(PostTrending.score <
+                               half_lives(datetime.now()) -
+                               TRENDING_MAX_HALF_LIVES)
+                        .execute())
+
+
+def rebuild_trending():
+    """
+        recompute Post_Trending from Post and Post_Like
+        used to backfill the table or repair it after drift
+    """
+    now = datetime.now()
+    since = now - timedelta(
+        hours=TRENDING_HALF_LIFE_HOURS * TRENDING_MAX_HALF_LIVES)
+    # sums of 2^(half lives before now), they stay small
+    sums = defaultdict(float)
+    posts = (Post.select(Post.id, Post.created)
+                 .where(Post.created > since)
+                 .tuples())
+    for post_id, created in posts.iterator():
+        sums[post_id] += TRENDING_POST_WEIGHT * 2 ** -half_lives(
+            now, created)
+    likes = (PostLike.select(PostLike.post_id, PostLike.created)
+                     .where(PostLike.created > since)
+                     .tuples())
+    for post_id, created in likes.iterator():
+        sums[post_id] += 2 ** -half_lives(now, created)
+    current = half_lives(now)
+    rows = [(post_id, current + math.log2(total))
+            for post_id, total in sums.items() if total > 0]
+    with db.atomic():
+        PostTrending.delete().execute()
+        for start in range(0, len(rows), 1000):
+            (PostTrending.insert_many(
+                rows[start:start + 1000],
+                [PostTrending.post_id, PostTrending.score])
+                .execute())
+
+
+def upsert_user(email, platform):
+    """
+        find the user of a login, registering it on the first one
+        returns the id of the user, None when the email is already used
+        with another platform
+        a returning user costs one SELECT, only a first login inserts: the
+        unique email index makes concurrent first logins insert once
+    """
+    user = (User.select(User.id, User.platform)
+            .where(User.email == email)
+            .first())
+    if user is None:
+        user = insert_user(email, platform)
+    return user.id if user.platform == platform else None
+
+
+def insert_user(email, platform):
+    """
+        the user of the email as (id, platform), inserted unless a
+        concurrent login did it first
+    """
+    if isinstance(db, MySQLDatabase):
+        # an existing row keeps its values, LAST_INSERT_ID(id) hands its id
+        # back as lastrowid
+        query = User.insert(email=email, platform=platform).on_conflict(
+            update={User.id: fn.LAST_INSERT_ID(User.id)})
+        cursor = db.execute(query)
+        if cursor.rowcount:
+            return User(id=cursor.lastrowid, platform=platform)
+        # without CLIENT_FOUND_ROWS the unchanged row counts 0, it was
+        # registered by the concurrent login, maybe with another platform
+        return (User.select(User.id, User.platform)
+                .where(User.id == cursor.lastrowid)
+                .first())
+    query = (User.insert(email=email, platform=platform)
+             .on_conflict(
+                 conflict_target=[User.email],
+                 update={User.email: EXCLUDED.email})
+             .returning(User.id, User.platform))
+    user_id, user_platform = db.execute(query).fetchone()
+    return User(id=user_id, platform=user_platform)
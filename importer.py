@@ -0,0 +1,127 @@
+"""
+    import users and posts from the old system
+        python importer.py users users.csv
+        python importer.py posts posts.jsonl
+
+    CSV files have a header row, JSONL files one object per line, with the
+    columns of the User or Post table (users need an email and a platform,
+    posts a title, a body and an author, id is optional). Rows are read
+    lazily and inserted with multi-row INSERTs, so memory stays flat on
+    any file size. Users whose email or rows whose id already exists are
+    skipped so an import can be run again
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from peewee import chunked
+from database import db
+from models import User, Post
+
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", 1000))
+
+USER_FIELDS = [User.id, User.email, User.platform, User.name,
+               User.phone_number, User.occupation]
+POST_FIELDS = [Post.id, Post.title, Post.body, Post.author, Post.created]
+
+
+def read_rows(path, file_format=None):
+    """
+        dicts of the rows of a CSV or JSONL file, read lazily
+    """
+    file_format = file_format or os.path.splitext(path)[1].lstrip(".")
+    with open(path, newline="") as f:
+        if file_format == "csv":
+            yield from csv.DictReader(f)
+        elif file_format in ("jsonl", "json"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            raise ValueError("Unknown format {}".format(file_format))
+
+
+def user_row(row):
+    """
+        tuple of USER_FIELDS, None when a required column is missing
+    """
+    email = (row.get("email") or "").strip()
+    platform = (row.get("platform") or "").strip()
+    if not email or not platform:
+        return None
+    # empty CSV cells are missing values
+    return (int(row["id"]) if row.get("id") else None, email, platform,
+            row.get("name") or None, row.get("phone_number") or None,
+            row.get("occupation") or None)
+
+
+def post_row(row):
+    """
+        tuple of POST_FIELDS, None when a required column is missing
+    """
+    title = row.get("title")
+    body = row.get("body")
+    if not title or body is None or not row.get("author"):
+        return None
+    # an explicit NULL would not get the column default
+    created = row.get("created") or datetime.now()
+    if isinstance(created, str):
+        created = datetime.fromisoformat(created)
+    return (int(row["id"]) if row.get("id") else None, title, body,
+            int(row["author"]), created)
+
+
+def import_rows(model, fields, convert, rows, chunk_size):
+    """
+        insert the rows chunk by chunk, one transaction per chunk
+        returns the counts of the import
+    """
+    counts = {"rows": 0, "inserted": 0, "invalid": 0}
+    for chunk in chunked(rows, chunk_size):
+        counts["rows"] += len(chunk)
+        values = [value for value in map(convert, chunk) if value]
+        counts["invalid"] += len(chunk) - len(values)
+        if not values:
+            continue
+        # unique keys (email, id) skip the rows that are already there
+        query = model.insert_many(values, fields).on_conflict_ignore()
+        with db.atomic():
+            counts["inserted"] += db.execute(query).rowcount
+    counts["skipped"] = counts["rows"] - counts["inserted"] - counts["invalid"]
+    return counts
+
+
+def import_users(rows, chunk_size=IMPORT_CHUNK_SIZE):
+    return import_rows(User, USER_FIELDS, user_row, rows, chunk_size)
+
+
+def import_posts(rows, chunk_size=IMPORT_CHUNK_SIZE):
+    return import_rows(Post, POST_FIELDS, post_row, rows, chunk_size)
+
+
+commands = {
+    "users": import_users,
+    "posts": import_posts,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Import data from the old system")
+    parser.add_argument("command", choices=sorted(commands))
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=["csv", "jsonl"],
+                        help="by default from the file extension")
+    parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    counts = commands[args.command](
+        read_rows(args.path, args.format), args.chunk_size)
+    seconds = time.perf_counter() - started
+    counts["seconds"] = round(seconds, 2)
+    counts["rows_per_second"] = round(counts["rows"] / seconds, 1)
+    json.dump(counts, sys.stdout)
+    print()
@@ -1,34 +1,228 @@
 from cmath import inf
-import json
+import asyncio
+import logging
 from fastapi import Depends, HTTPException, Request, Response
 from fastapi import FastAPI
-from fastapi.responses import (RedirectResponse, HTMLResponse)
-from auth import AuthHandler
+from fastapi.responses import (
+    RedirectResponse,
+    HTMLResponse,
+    StreamingResponse,
+    ORJSONResponse,
+    PlainTextResponse)
+from auth import AuthHandler, USER_CACHE_TTL
 from playhouse.shortcuts import model_to_dict
-from peewee import JOIN
+from database import (
+    db,
+    get_db,
+    close_all,
+    pool_stats,
+    use_replica,
+    mark_write,
+    replicas,
+    read_replica,
+    reset_db_state,
+    DB_REPLICA_STICKY_SECONDS,
+    DB_REPLICA_RETRY_SECONDS
+)
 from exception import RequiresExtraInfoException
+from admission import (
+    parse_rate,
+    RateLimiter,
+    ConcurrencyLimiter,
+    too_many_requests,
+    service_unavailable
+)
+from playhouse.pool import MaxConnectionsExceeded
 from schemas import (
     Credentials,
     AdditionalInfo,
-    PostCreate
+    PostCreate,
+    PostBulk,
+    LikeBatch
 )
 from models import (
     User,
     Post,
     PostLike
 )
-from helper import get_likes_subquery
-from google.oauth2 import id_token
-from google.auth.transport import requests
-import requests as rq
-from dotenv import load_dotenv
+from helper import (
+    get_posts_query,
+    get_user_summary_query,
+    insert_posts,
+    count_posts,
+    parse_fields,
+    attach_likes,
+    iter_posts,
+    get_liked_posts_query,
+    get_likes_query,
+    before_like,
+    insert_likes,
+    record_likes,
+    add_like,
+    after_cursor,
+    encode_cursor,
+    decode_cursor,
+    encode_rank_cursor,
+    decode_rank_cursor,
+    bump_trending,
+    get_trending_query,
+    POST_FIELDS,
+    upsert_user,
+    decayed_score,
+    prune_trending,
+    TRENDING_POST_WEIGHT
+)
+from search import get_search_index
+import async_db
+import warmup
+from providers import get_provider
+import providers
+from cache import ResponseCache, MemoryBackend, RedisBackend
+from metrics import MetricsMiddleware
+import metrics
+import orjson
+from urllib.parse import urlencode
+from starlette.concurrency import run_in_threadpool
 import os
-load_dotenv()
-GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
-FACEBOOK_APP_ID = os.getenv("FACEBOOK_APP_ID")
-FACEBOOK_APP_SECRET = os.getenv("FACEBOOK_APP_SECRET")
-app = FastAPI()
+POSTS_PER_PAGE = int(os.getenv("POSTS_PER_PAGE", 3))
+MAX_POSTS_PER_PAGE = int(os.getenv("MAX_POSTS_PER_PAGE", 50))
+MAX_BATCH_LIKES = int(os.getenv("MAX_BATCH_LIKES", 100))
+MAX_BULK_POSTS = int(os.getenv("MAX_BULK_POSTS", 1000))
+BULK_POSTS_CHUNK_SIZE = int(os.getenv("BULK_POSTS_CHUNK_SIZE", 200))
+# requests per user of every write endpoint, "count/seconds", empty for no
+# limit
+RATE_LIMITS = {
+    route: parse_rate(os.getenv("RATE_LIMIT_" + route.upper(), default))
+    for route, default in (
+        ("create_post", "10/60"),
+        ("create_posts", "5/60"),
+        ("like_post", "60/60"),
+        ("like_posts", "10/60"),
+    )
+}
+LIKES_PER_PAGE = int(os.getenv("LIKES_PER_PAGE", 20))
+MAX_LIKES_PER_PAGE = int(os.getenv("MAX_LIKES_PER_PAGE", 100))
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", 100))
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory")
+RESPONSE_CACHE_URL = os.getenv("RESPONSE_CACHE_URL")
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 1024))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 300))
+MAX_SEARCH_QUERY_LENGTH = int(os.getenv("MAX_SEARCH_QUERY_LENGTH", 200))
+TRENDING_PRUNE_SECONDS = int(os.getenv("TRENDING_PRUNE_SECONDS", 300))
+# every request checks out its own connection and returns it at the end
+app = FastAPI(
+    dependencies=[Depends(get_db)],
+    default_response_class=ORJSONResponse)
+# query count and time of every request in Server-Timing and /metrics
+app.add_middleware(MetricsMiddleware)
 auth_handler = AuthHandler()
+if RESPONSE_CACHE_BACKEND == "redis":
+    response_cache_backend = RedisBackend(
+        RESPONSE_CACHE_URL, RESPONSE_CACHE_TTL)
+    # the other workers must see the user records a worker changed and the
+    # users who wrote lately
+    auth_handler.user_cache = response_cache_backend.ttl_cache(
+        "auth:", USER_CACHE_TTL)
+    if replicas is not None:
+        replicas.writers = response_cache_backend.ttl_cache(
+            "sticky:", DB_REPLICA_STICKY_SECONDS)
+else:
+    response_cache_backend = MemoryBackend(
+        RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+# a replica may lack a write until the sticky time is over
+response_cache = ResponseCache(
+    response_cache_backend,
+    DB_REPLICA_STICKY_SECONDS if replicas is not None else 0)
+search_index = get_search_index()
+rate_limiters = {route: RateLimiter(*rate)
+                 for route, rate in RATE_LIMITS.items() if rate}
+write_limiter = ConcurrencyLimiter()
+
+
+background_tasks = []
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    background_tasks.append(asyncio.create_task(prune_trending_periodically()))
+    if replicas is not None:
+        background_tasks.append(
+            asyncio.create_task(check_replicas_periodically()))
+
+
+@app.on_event("startup")
+async def warm_up():
+    """
+        runs before the worker takes traffic: open the connections of the
+        pool, load the users of the latest posts into the user cache and
+        serve the first feed pages into the response cache
+    """
+    try:
+        # a connection state of its own, like a request
+        await reset_db_state()
+        await run_in_threadpool(warmup.open_connections)
+        await async_db.connect()
+        users = await run_in_threadpool(warmup.recent_users)
+        for user in users:
+            await off_loop(auth_handler.cache_user, user)
+        # the feed is the same for everyone, any user with the extra
+        # information can fetch it
+        users = [user for user in users if user["name"]]
+        if users:
+            headers = {"Authorization": "Bearer " + auth_handler.encode_token(
+                users[0]["email"])}
+            for path in warmup.WARM_PATHS:
+                await warmup.request(app, path, headers)
+    except Exception:
+        # a cold worker is better than no worker
+        warmup.log.exception("Warm-up failed")
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    # runs once the server stopped accepting and the requests in flight
+    # are done (or the graceful timeout passed)
+    # the background tasks stop first, they use the connections closed next
+    for task in background_tasks:
+        task.cancel()
+    await providers.close()
+    await async_db.close()
+    close_all()
+
+
+async def prune_trending_periodically():
+    """
+        drop the decayed posts from the trending table now and then
+        the scores themselves need no update to decay
+    """
+    def prune():
+        with db.connection_context():
+            prune_trending()
+
+    while True:
+        await asyncio.sleep(TRENDING_PRUNE_SECONDS)
+        # a connection state of its own, like a request
+        await reset_db_state()
+        try:
+            await run_in_threadpool(prune)
+        except Exception:
+            logging.getLogger("trending").exception("Pruning failed")
+
+
+async def check_replicas_periodically():
+    """
+        ping the replicas every DB_REPLICA_RETRY_SECONDS, so one that came
+        back is used again and one that went down is skipped without a
+        request failing on it first
+    """
+    while True:
+        await asyncio.sleep(DB_REPLICA_RETRY_SECONDS)
+        # a connection state of its own, like a request
+        await reset_db_state()
+        try:
+            await run_in_threadpool(replicas.check)
+        except Exception:
+            logging.getLogger("replicas").exception("Replica check failed")
 
 
 @app.get('/login', response_class=HTMLResponse, include_in_schema=False)
@@ -95,94 +289,214 @@ def login():
         </html>
     """
 
+# ------------------------ Response cache ------------------------ #
+
+
+def cached_response(request, key, build):
+    """
+        serve a read endpoint from the response cache
+        build returns the data and the tags writes invalidate it with
+        clients sending back the ETag get a 304 without any query
+    """
+    sticky, entry, since = cache_lookup(request, key)
+    if sticky:
+        data, _ = build()
+        return etag_response(
+            request, response_cache.entry(orjson.dumps(data)))
+    if entry is None:
+        # orjson encodes the rows and their datetimes directly, no
+        # jsonable_encoder pass over every dict
+        data, tags = build()
+        entry = response_cache.set(
+            key, orjson.dumps(data), tags,
+            read_replica.get() is not None, since)
+    return etag_response(request, entry)
+
+
+async def cached_response_async(request, key, build):
+    """
+        cached_response for async endpoints, build is a coroutine function
+    """
+    sticky, entry, since = await off_loop(cache_lookup, request, key)
+    if sticky:
+        data, _ = await build()
+        return etag_response(
+            request, response_cache.entry(orjson.dumps(data)))
+    if entry is None:
+        data, tags = await build()
+        # the async driver only reads the primary
+        replica = async_db.adb is None and read_replica.get() is not None
+        entry = await off_loop(
+            response_cache.set, key, orjson.dumps(data), tags, replica, since)
+    return etag_response(request, entry)
+
+
+def cache_lookup(request, key):
+    """
+        (sticky, entry, version) of a read: sticky users skip the cache,
+        on a miss the version is read before the build, a write during the
+        build makes the response outdated
+    """
+    if is_sticky(request):
+        return True, None, None
+    entry = response_cache.get(key)
+    if entry is not None:
+        return False, entry, None
+    return False, None, response_cache.version()
+
+
+async def off_loop(func, *args):
+    """
+        call the response cache or the sticky set from async code, kept in
+        Redis they are blocking round trips and run in the threadpool so a
+        slow reply does not stall every request of the worker
+    """
+    if RESPONSE_CACHE_BACKEND == "redis":
+        return await run_in_threadpool(func, *args)
+    return func(*args)
+
+
+def is_sticky(request):
+    """
+        the user wrote lately and reads from the primary, the response
+        cache is skipped too, it may not have the write yet
+    """
+    user = getattr(request.state, "user", None)
+    return (replicas is not None and user is not None and
+            replicas.is_sticky(user["id"]))
+
+
+def etag_response(request, entry):
+    etag, body = entry
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def invalidate(*tags):
+    response_cache.invalidate(*tags)
+
+
+def wrote(user_id, *tags):
+    """
+        after a write of the user: reads stick to the primary and the
+        cached responses of the tags are dropped
+    """
+    mark_write(user_id)
+    invalidate(*tags)
+
+
+def cache_key(name, request):
+    return name + "?" + urlencode(sorted(request.query_params.multi_items()))
+
+
+def stream_ndjson(query, fields):
+    # the response is sent after the request dependencies ran, so the
+    # generator holds its own connection while it reads
+    with db.connection_context():
+        for post in iter_posts(query, STREAM_BATCH_SIZE, fields):
+            yield orjson.dumps(post) + b"\n"
+
+
+def list_fields(fields, include, likes):
+    try:
+        return parse_fields(fields, include, likes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def post_tags(posts):
+    """
+        tags of the posts and of the users whose names they show
+    """
+    tags = []
+    for post in posts:
+        tags.append("post:{}".format(post["id"]))
+        if "author_id" in post:
+            tags.append("name:{}".format(post["author_id"]))
+        tags += like_tags(post.get("likes", []))
+    return list(dict.fromkeys(tags))
+
+
+def like_tags(likes):
+    return ["name:{}".format(like["user_id"]) for like in likes]
+
+
+def rate_limit(route):
+    """
+        dependency of a write endpoint, a user sending more requests than
+        its RATE_LIMIT_<ROUTE> gets a 429 before any query
+        async so it answers without waiting for the threadpool
+    """
+    limiter = rate_limiters.get(route)
+
+    async def check(user_info=Depends(auth_handler.auth_wrapper)):
+        if limiter is None:
+            return
+        retry_after = limiter.acquire(user_info['id'])
+        if retry_after:
+            raise too_many_requests(retry_after)
+    return check
+
+
+async def admit_write():
+    """
+        dependency of the write endpoints, after rate_limit: over
+        MAX_CONCURRENT_WRITES or with every pool connection taken the
+        request gets a 503 right away instead of queueing for a connection
+    """
+    if not write_limiter.acquire():
+        raise service_unavailable()
+    try:
+        yield
+    finally:
+        write_limiter.release()
+
 # ------------------------ Handle Accounts ------------------------ #
 
 
-@app.post('/api/login/google')
-def login_google(credentials: Credentials):
-    access_token = credentials.access_token
-    # verify google token
+def register_user(email, platform):
+    """
+        register the user on first login
+        an email can only be used with one platform
+    """
+    if upsert_user(email, platform) is None:
+        raise HTTPException(
+            status_code=400,
+            detail="This email is already exists")
+
+
+async def login_with(platform, credentials):
+    """
+        verify the token with the provider of the platform
+        and register the user on first login
+    """
+    provider = await get_provider(platform)
+    if provider is None:
+        raise HTTPException(
+            status_code=404,
+            detail="Login with {} is not enabled".format(platform))
     try:
-        idinfo = id_token.verify_oauth2_token(
-            access_token, requests.Request(), GOOGLE_CLIENT_ID)
-        # check if email is already exists in database
-        exists_user = (User.select()
-                       .where(User.email == idinfo["email"])
-                       .first())
-        if exists_user and exists_user.platform == "facebook":
-            raise HTTPException(
-                status_code=400,
-                detail="This email is already exists")
-        if not exists_user:
-            # register new user to database
-            db_user = User(
-                email=idinfo["email"],
-                platform="google"
-            )
-            db_user.save()
-        # return access_token for user
-        token = auth_handler.encode_token(idinfo["email"])
-        return {"access_token": token}
+        email = await provider.get_email(credentials.access_token)
     except ValueError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    # database access is blocking, keep it off the event loop
+    await run_in_threadpool(register_user, email, platform)
+    # return access_token for user
+    token = auth_handler.encode_token(email)
+    return {"access_token": token}
+
+
+@app.post('/api/login/google')
+async def login_google(credentials: Credentials):
+    return await login_with("google", credentials)
 
 
 @app.post('/api/login/facebook')
-def login_facebook(credentials: Credentials):
-    access_token = credentials.access_token
-    try:
-        # get app access_token first
-        res = rq.get("https://graph.facebook.com/oauth/access_token",
-            params={
-                "client_id": FACEBOOK_APP_ID,
-                "client_secret": FACEBOOK_APP_SECRET,
-                "grant_type": "client_credentials"})
-        res.raise_for_status()
-        res = res.json()
-        if "access_token" not in res:
-            raise HTTPException(
-                status_code=400,
-                detail="Invalid token")
-        app_access_token = res["access_token"]
-        # verify app_id in access_token sent from client
-        res = rq.get("https://graph.facebook.com/debug_token",
-            params={
-                "input_token": access_token,
-                "access_token": app_access_token})
-        res.raise_for_status()
-        res = res.json()
-        if not res.get("data") and res.get("data").get("app_id") != FACEBOOK_APP_ID:
-            raise HTTPException(
-                status_code=401,
-                detail="Not authorized")
-        res = rq.get(
-            "https://graph.facebook.com/me?access_token=&fields=email",
-            params={
-                "access_token": access_token,
-                "fields": "email"})
-
-        res.raise_for_status()
-        info = res.json()
-        # check if email is already exists in database
-        exists_user = (User.select()
-                       .where(User.email == info["email"])
-                       .first())
-        if exists_user and exists_user.platform == "google":
-            raise HTTPException(
-                status_code=400,
-                detail="This email is already exists")
-        if not exists_user:
-            # register new user to database
-            db_user = User(
-                email=info["email"],
-                platform="facebook"
-            )
-            db_user.save()
-        # return access_token for user
-        token = auth_handler.encode_token(info["email"])
-        return {"access_token": token}
-    except rq.exceptions.HTTPError as e:
-        raise HTTPException(status_code=401, detail="Invalid token")
+async def login_facebook(credentials: Credentials):
+    return await login_with("facebook", credentials)
 
 
 @app.patch('/api/users/self', status_code=204)
@@ -203,19 +517,29 @@ def add_information(
         raise HTTPException(
             status_code=400,
             detail="You need to provide occupation information")
+    renamed = user.name != details.name
     user.name = details.name
     if details.phone_number:
         user.phone_number = details.phone_number
     if details.occupation:
         user.occupation = details.occupation
     user.save()
+    mark_write(user.id)
+    # the cached record is outdated now
+    auth_handler.invalidate_user(user.email)
+    if renamed:
+        # posts and likes show the name
+        invalidate("name:{}".format(user.id))
     return Response(status_code=204)
 
 # ------------------------ Handle Posts ------------------------ #
 
 
-@app.post('/api/posts',
-          dependencies=[Depends(auth_handler.verify_information)])
+@app.post('/api/posts', dependencies=[
+    Depends(auth_handler.verify_information),
+    Depends(rate_limit("create_post")),
+    Depends(admit_write)
+])
 def create_post(
     post_data: PostCreate,
     user_info=Depends(auth_handler.auth_wrapper)  # authentication
@@ -228,148 +552,454 @@ def create_post(
         body=post_data.body,
         author=user_info['id']
     )
-    new_post.save()
+    with db.atomic():
+        new_post.save()
+        count_posts(new_post.author, 1)
+        if TRENDING_POST_WEIGHT > 0:
+            bump_trending([new_post.id], TRENDING_POST_WEIGHT)
+    search_index.add(new_post.id, new_post.title, new_post.body)
+    mark_write(user_info['id'])
+    # the new post shows up in the feed, the search results and in the
+    # author's posts
+    invalidate(
+        "feed",
+        "user:{}".format(new_post.author),
+        "post:{}".format(new_post.id))
     return model_to_dict(new_post)
 
 
-@app.post('/api/posts/{post_id}/likes',
-          dependencies=[Depends(auth_handler.verify_information)])
-def like_post(
-    post_id,
+@app.post('/api/posts/bulk', status_code=201, dependencies=[
+    Depends(auth_handler.verify_information),
+    Depends(rate_limit("create_posts")),
+    Depends(admit_write)
+])
+def create_posts(
+    bulk: PostBulk,
+    user_info=Depends(auth_handler.auth_wrapper)  # authentication
+):
+    """
+        Create many posts at once, for content migrated from other sites
+        all posts are created or none
+    """
+    if len(bulk.posts) > MAX_BULK_POSTS:
+        raise HTTPException(
+            status_code=400,
+            detail="At most {} posts per request".format(MAX_BULK_POSTS))
+    posts = [(post.title, post.body) for post in bulk.posts]
+    post_ids = []
+    if posts:
+        with db.atomic():
+            if db.for_update:
+                # a concurrent bulk of the same user waits for this one, so
+                # the ids read back by insert_posts are ours
+                (User.select(User.id)
+                 .where(User.id == user_info['id'])
+                 .for_update()
+                 .execute())
+            post_ids = insert_posts(
+                posts, user_info['id'], BULK_POSTS_CHUNK_SIZE)
+            count_posts(user_info['id'], len(post_ids))
+            if TRENDING_POST_WEIGHT > 0:
+                bump_trending(post_ids, TRENDING_POST_WEIGHT)
+        for post_id, (title, body) in zip(post_ids, posts):
+            search_index.add(post_id, title, body)
+        mark_write(user_info['id'])
+        # as in create_post, get_post may have cached a miss of the ids
+        invalidate("feed", "user:{}".format(user_info['id']),
+                   *["post:{}".format(post_id) for post_id in post_ids])
+    return {"post_ids": post_ids}
+
+
+@app.post('/api/posts/{post_id}/likes', dependencies=[
+    Depends(auth_handler.verify_information),
+    Depends(rate_limit("like_post")),
+    Depends(admit_write)
+])
+async def like_post(
+    post_id: int,
     user_info=Depends(auth_handler.auth_wrapper)  # authentication
 ):
     """
         Like post
     """
-    # check if post exists
-    post = Post.select().where(Post.id == post_id).first()
-    if not post:
-        raise HTTPException(
-            status_code=401,
-            detail="This post does not exists")
-    # check if user already like the post
-    post_like = (PostLike.select()
-                         .where(PostLike.post_id == post_id)
-                         .where(PostLike.user_id == user_info['id'])
-                         .first())
-    if post_like:
+    like_id = await async_db.add_like(post_id, user_info['id'])
+    if like_id is None:
+        # nothing inserted: the post does not exist or is already liked
+        if not await async_db.post_exists(post_id):
+            raise HTTPException(
+                status_code=401,
+                detail="This post does not exists")
         return Response(status_code=204)
-    new_like = PostLike(
-        post_id=int(post_id),
+    # every cached response showing the post is tagged with it
+    await off_loop(wrote, user_info['id'], "post:{}".format(post_id))
+    return model_to_dict(PostLike(
+        id=like_id,
+        post_id=post_id,
         user_id=user_info['id']
-    )
-    new_like.save()
-    return model_to_dict(new_like)
+    ))
+
+
+@app.post('/api/posts/likes/batch', dependencies=[
+    Depends(auth_handler.verify_information),
+    Depends(rate_limit("like_posts")),
+    Depends(admit_write)
+])
+def like_posts(
+    batch: LikeBatch,
+    user_info=Depends(auth_handler.auth_wrapper)  # authentication
+):
+    """
+        Like many posts at once, for likes queued by offline clients
+    """
+    post_ids = sorted(set(batch.post_ids))
+    if len(post_ids) > MAX_BATCH_LIKES:
+        raise HTTPException(
+            status_code=400,
+            detail="At most {} posts per batch".format(MAX_BATCH_LIKES))
+    liked = []
+    already_liked = []
+    if post_ids:
+        with db.atomic():
+            # which posts exist and which of them the user already liked
+            posts = get_liked_posts_query(post_ids, user_info['id'])
+            if db.for_update:
+                # a concurrent batch of the same user waits for this one
+                posts = posts.for_update()
+            for post in posts.dicts():
+                if post["like_id"]:
+                    already_liked.append(post["id"])
+                else:
+                    liked.append(post["id"])
+            if liked:
+                with db.atomic() as savepoint:
+                    inserted = insert_likes(liked, user_info['id']).rowcount
+                    if inserted < len(liked):
+                        # a like of the user committed since the check,
+                        # which rows are ours is unknown
+                        savepoint.rollback()
+                if inserted == len(liked):
+                    record_likes(liked, user_info['id'])
+                else:
+                    # one at a time, only new likes update the projections
+                    posts, liked = liked, []
+                    for post_id in posts:
+                        if add_like(post_id, user_info['id']) is None:
+                            already_liked.append(post_id)
+                        else:
+                            liked.append(post_id)
+        if liked:
+            mark_write(user_info['id'])
+            invalidate(
+                *["post:{}".format(post_id) for post_id in liked])
+    missing = sorted(set(post_ids) - set(liked) - set(already_liked))
+    return {
+        "liked": sorted(liked),
+        "already_liked": sorted(already_liked),
+        "missing": missing
+    }
 
 
 @app.get('/api/posts', dependencies=[
     Depends(auth_handler.auth_wrapper),
-    Depends(auth_handler.verify_information)
+    Depends(auth_handler.verify_information),
+    Depends(use_replica)
 ])
-def list_posts(
-    page: int = 1
+async def list_posts(
+    request: Request,
+    page: int = None,
+    cursor: str = None,
+    limit: int = None,
+    fields: str = None,
+    include: str = None,
+    likes: str = None
 ):
     """
         List all posts in the home page and likes for each post
         The likes for each post will be sorted by time
+        Pass `cursor` (empty for the first page) to page by keyset instead
+        of offset, the response then carries the `next_cursor` to send back
+        Posts come with a short description instead of the body, add
+        `include=body` for it, pick fields with `fields=id,title,...` or
+        send `likes=count` to leave out the likes list
     """
-    items_per_page = 3
-    likes_subquery = get_likes_subquery()
-    posts = (
-        Post.select(
-            User.name.alias("author_name"),
-            Post.title,
-            Post.body,
-            Post.created,
-            likes_subquery.c.likes,
-        ) .join(
-            User,
-            on=Post.author == User.id) .join(
-                likes_subquery,
-                JOIN.LEFT_OUTER,
-                on=likes_subquery.c.post_id == Post.id) .order_by(
-                    Post.created) .group_by(
-                        Post.id) .paginate(
-                            page,
-            items_per_page) .dicts())
-
-    # add short description and likes for each post
+    items_per_page = min(limit or POSTS_PER_PAGE, MAX_POSTS_PER_PAGE)
+    if items_per_page < 1:
+        raise HTTPException(status_code=400, detail="Invalid limit")
+    post_fields = list_fields(fields, include, likes)
+
+    async def build():
+        posts = get_posts_query(post_fields).order_by(Post.created, Post.id)
+        if cursor is None:
+            posts = await async_db.fetch_posts(
+                posts.paginate(page or 1, items_per_page), post_fields)
+            return posts, ["feed"] + post_tags(posts)
+
+        if cursor:
+            try:
+                posts = posts.where(after_cursor(cursor))
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+        # fetch one extra row to know if there is a next page
+        posts = await async_db.fetch(
+            posts.limit(items_per_page + 1).dicts())
+        next_cursor = None
+        if len(posts) > items_per_page:
+            posts = posts[:items_per_page]
+            next_cursor = encode_cursor(posts[-1]["created"], posts[-1]["id"])
+        posts = await async_db.attach_likes(posts, post_fields)
+        return ({"posts": posts, "next_cursor": next_cursor},
+                ["feed"] + post_tags(posts))
+
+    return await cached_response_async(
+        request, cache_key("feed", request), build)
+
+
+# trending and search are declared before /api/posts/{post_id} so their
+# names are not taken for an id
+@app.get('/api/posts/trending', dependencies=[
+    Depends(auth_handler.auth_wrapper),
+    Depends(auth_handler.verify_information),
+    Depends(use_replica)
+])
+def trending_posts(
+    limit: int = None,
+    fields: str = None,
+    include: str = None,
+    likes: str = None
+):
+    """
+        Most liked posts lately, a like counts half as much every
+        TRENDING_HALF_LIFE_HOURS
+        `fields`, `include` and `likes` work as in the home page list
+    """
+    items_per_page = min(limit or POSTS_PER_PAGE, MAX_POSTS_PER_PAGE)
+    if items_per_page < 1:
+        raise HTTPException(status_code=400, detail="Invalid limit")
+    post_fields = list_fields(fields, include, likes)
+    scores = {row["post_id"]: row["score"]
+              for row in get_trending_query(items_per_page).dicts()}
+    if not scores:
+        return []
+    posts = [post for post in get_posts_query(post_fields)
+             .where(Post.id.in_(list(scores)))
+             .dicts()]
     for post in posts:
-        post["likes"] = json.loads(
-            '[' + post["likes"] + ']') if post["likes"] else []
-        post["short_description"] = post["body"][:100]
-    return [post for post in posts]
+        post["trending_score"] = decayed_score(scores[post["id"]])
+    posts.sort(key=lambda post: (scores[post["id"]], post["id"]),
+               reverse=True)
+    return attach_likes(posts, post_fields)
+
+
+@app.get('/api/posts/search', dependencies=[
+    Depends(auth_handler.auth_wrapper),
+    Depends(auth_handler.verify_information),
+    Depends(use_replica)
+])
+def search_posts(
+    request: Request,
+    q: str,
+    cursor: str = None,
+    limit: int = None,
+    fields: str = None,
+    include: str = None,
+    likes: str = None
+):
+    """
+        Search posts by title and body, best matches first
+        Send back the `next_cursor` of a response to get the next page
+        `fields`, `include` and `likes` work as in the home page list
+    """
+    q = q.strip()
+    if not q or len(q) > MAX_SEARCH_QUERY_LENGTH:
+        raise HTTPException(status_code=400, detail="Invalid query")
+    items_per_page = min(limit or POSTS_PER_PAGE, MAX_POSTS_PER_PAGE)
+    if items_per_page < 1:
+        raise HTTPException(status_code=400, detail="Invalid limit")
+    post_fields = list_fields(fields, include, likes)
+    after = None
+    if cursor:
+        try:
+            after = decode_rank_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    def build():
+        # fetch one extra result to know if there is a next page
+        results = search_index.search(q, items_per_page + 1, after)
+        next_cursor = None
+        if len(results) > items_per_page:
+            results = results[:items_per_page]
+            next_cursor = encode_rank_cursor(*results[-1][::-1])
+        scores = dict(results)
+        posts = [post for post in get_posts_query(post_fields)
+                 .where(Post.id.in_(list(scores)))
+                 .dicts()] if scores else []
+        for post in posts:
+            post["score"] = scores[post["id"]]
+        posts.sort(key=lambda post: (post["score"], post["id"]), reverse=True)
+        posts = attach_likes(posts, post_fields)
+        return ({"posts": posts, "next_cursor": next_cursor},
+                ["feed"] + post_tags(posts))
+
+    return cached_response(request, cache_key("search", request), build)
+
+
+@app.get("/api/users/{user_id}", dependencies=[
+    Depends(auth_handler.auth_wrapper),
+    Depends(auth_handler.verify_information),
+    Depends(use_replica)
+])
+async def get_user_summary(user_id: int):
+    """
+        Profile of a user for an author card, with the number of posts,
+        likes received and the time of the latest post
+        the counters are read from User_Stats, no post is counted
+    """
+    users = await async_db.fetch(get_user_summary_query(user_id).dicts())
+    if not users:
+        raise HTTPException(status_code=404, detail="User not exists")
+    return users[0]
 
 
 @app.get("/api/users/{user_id}/posts", dependencies=[
     Depends(auth_handler.auth_wrapper),
-    Depends(auth_handler.verify_information)
+    Depends(auth_handler.verify_information),
+    Depends(use_replica)
 ])
-def list_posts_for_user(
-    user_id: int
+async def list_posts_for_user(
+    request: Request,
+    user_id: int,
+    stream: bool = False,
+    fields: str = None,
+    include: str = None,
+    likes: str = None
 ):
     """
         List all posts in the home page by an user
         The likes for each post will be sorted by time
+        With `stream=1` or `Accept: application/x-ndjson` posts are sent
+        one json per line as they are read
+        `fields`, `include` and `likes` work as in the home page list
     """
-    likes_subquery = get_likes_subquery()
-    posts = (
-        Post.select(
-            User.name.alias("author_name"),
-            Post.title,
-            Post.body,
-            Post.created,
-            likes_subquery.c.likes) .join(
-            User,
-            on=Post.author == User.id) .join(
-                likes_subquery,
-                JOIN.LEFT_OUTER,
-                on=likes_subquery.c.post_id == Post.id) .where(
-                    Post.author == user_id) .order_by(
-                        Post.created) .dicts())
-    # adding short description for each posts
-    for post in posts:
-        post["likes"] = json.loads(
-            '[' + post["likes"] + ']') if post["likes"] else []
-        post["short_description"] = post["body"][:100]
-    return [post for post in posts]
+    post_fields = list_fields(fields, include, likes)
+    if stream or "application/x-ndjson" in request.headers.get("accept", ""):
+        posts = get_posts_query(post_fields).where(Post.author == user_id)
+        return StreamingResponse(
+            stream_ndjson(posts, post_fields),
+            media_type="application/x-ndjson")
+
+    async def build():
+        # adding likes for each posts
+        posts = await async_db.fetch_posts(
+            get_posts_query(post_fields)
+            .where(Post.author == user_id)
+            .order_by(Post.created, Post.id),
+            post_fields)
+        return posts, ["user:{}".format(user_id)] + post_tags(posts)
+
+    return await cached_response_async(
+        request, cache_key("user:{}".format(user_id), request), build)
 
 
 @app.get("/api/posts/{post_id}", dependencies=[
     Depends(auth_handler.auth_wrapper),
-    Depends(auth_handler.verify_information)
+    Depends(auth_handler.verify_information),
+    Depends(use_replica)
 ])
-def get_post(
+async def get_post(
+    request: Request,
     post_id: int
 ):
     """
         get full content of a post
     """
-    likes_subquery = get_likes_subquery()
-    posts = (
-        Post.select(
-            User.name.alias("author_name"),
-            Post.title,
-            Post.body,
-            Post.created,
-            likes_subquery.c.likes) .join(
-            User,
-            on=Post.author == User.id) .join(
-                likes_subquery,
-                JOIN.LEFT_OUTER,
-                on=likes_subquery.c.post_id == Post.id) .where(
-                    Post.id == post_id) .dicts())
-
-    posts = [post for post in posts]
-    if not posts:
-        return None
-    post = posts[0]
-
-    # adding short description for post
-    post["likes"] = json.loads(
-        '[' + post["likes"] + ']') if post["likes"] else []
-    post["short_description"] = post["body"][:100]
-    return post
+    async def build():
+        posts = await async_db.fetch(
+            get_posts_query().where(Post.id == post_id).dicts())
+        if not posts:
+            return None, ["post:{}".format(post_id)]
+
+        # adding likes for post
+        posts = await async_db.attach_likes(posts, POST_FIELDS)
+        return posts[0], post_tags(posts)
+
+    return await cached_response_async(
+        request, "post:{}".format(post_id), build)
+
+
+@app.get("/api/posts/{post_id}/likes", dependencies=[
+    Depends(auth_handler.auth_wrapper),
+    Depends(auth_handler.verify_information),
+    Depends(use_replica)
+])
+def list_likes(
+    request: Request,
+    post_id: int,
+    cursor: str = None,
+    limit: int = None
+):
+    """
+        List all likes of a post from the newest, page by page
+        Posts only carry their latest likes, this endpoint has all of them
+        Send back the `next_cursor` of a response to get the next page
+    """
+    items_per_page = min(limit or LIKES_PER_PAGE, MAX_LIKES_PER_PAGE)
+    if items_per_page < 1:
+        raise HTTPException(status_code=400, detail="Invalid limit")
+
+    def build():
+        likes = get_likes_query(post_id)
+        if cursor:
+            try:
+                likes = likes.where(before_like(*decode_cursor(cursor)))
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+        # fetch one extra row to know if there is a next page
+        likes = [like for like in likes.limit(items_per_page + 1).dicts()]
+        next_cursor = None
+        if len(likes) > items_per_page:
+            likes = likes[:items_per_page]
+            next_cursor = encode_cursor(likes[-1]["created"], likes[-1]["id"])
+        return ({"likes": likes, "next_cursor": next_cursor},
+                ["post:{}".format(post_id)] + like_tags(likes))
+
+    return cached_response(
+        request, cache_key("likes:{}".format(post_id), request), build)
+
+
+@app.get('/api/db/pool', include_in_schema=False)
+def db_pool():
+    """
+        connection pool usage to size DB_POOL_MAX_SIZE
+    """
+    stats = pool_stats()
+    if stats is None:
+        raise HTTPException(status_code=404, detail="Pool is not enabled")
+    # connections of the async endpoints with ASYNC_DB
+    stats["async"] = async_db.pool_stats()
+    # write requests in flight and refused by admit_write
+    stats["writes"] = write_limiter.stats()
+    return stats
+
+
+@app.get('/metrics',
+         response_class=PlainTextResponse,
+         include_in_schema=False)
+def get_metrics():
+    """
+        per route latency and query histograms for Prometheus
+    """
+    return metrics.render()
+
+
+@app.get('/api/db/replicas', include_in_schema=False)
+def db_replicas():
+    """
+        replicas and whether reads are sent to them
+    """
+    if replicas is None:
+        raise HTTPException(status_code=404, detail="No replicas")
+    return replicas.health()
 
 
 # ------------------------ Handle extra information ------------------------ #
@@ -379,6 +1009,17 @@ async def exception_handler(request: Request, exc: RequiresExtraInfoException) -
     # redirected to a form to provide additional information
     return RedirectResponse(url='/user/extra_information')
 
+
+@app.exception_handler(MaxConnectionsExceeded)
+async def pool_exhausted_handler(
+        request: Request, exc: MaxConnectionsExceeded):
+    # no connection came back within DB_POOL_WAIT_TIMEOUT
+    error = service_unavailable()
+    return ORJSONResponse(
+        {"detail": error.detail},
+        status_code=error.status_code,
+        headers=error.headers)
+
 # handle extra information form
 # this should be a frontend page so I only implemented as a placeholder
 
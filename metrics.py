@@ -0,0 +1,146 @@
+import os
+import threading
+import time
+from collections import defaultdict
+from database import QueryStats, query_stats, slow_query_log
+
+# warn about requests running more statements than this, 0 to disable
+# a page of posts runs a fixed number of queries, more is an N+1
+MAX_QUERIES_PER_REQUEST = int(os.getenv("MAX_QUERIES_PER_REQUEST", 0))
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                   2.5, 5, 10)
+QUERIES_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram():
+    """
+        Prometheus histogram with one series per label values
+    """
+
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket..., count, sum]
+        self._series = defaultdict(lambda: [0] * (len(buckets) + 2))
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series[label_values]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} histogram".format(self.name)
+        ]
+        with self._lock:
+            series = {key: list(value) for key, value in self._series.items()}
+        for label_values, values in sorted(series.items()):
+            labels = ",".join('{}="{}"'.format(name, value) for name, value
+                              in zip(self.labels, label_values))
+            for bound, count in zip(self.buckets, values):
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                    self.name, labels, bound, count))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(
+                self.name, labels, values[-2]))
+            lines.append("{}_count{{{}}} {}".format(
+                self.name, labels, values[-2]))
+            lines.append("{}_sum{{{}}} {}".format(
+                self.name, labels, values[-1]))
+        return lines
+
+
+request_seconds = Histogram(
+    "http_request_duration_seconds",
+    "Time to serve a request",
+    ("method", "route", "status"),
+    SECONDS_BUCKETS)
+db_queries = Histogram(
+    "http_request_db_queries",
+    "SQL statements run by a request",
+    ("method", "route"),
+    QUERIES_BUCKETS)
+db_seconds = Histogram(
+    "http_request_db_seconds",
+    "Time spent in SQL statements by a request",
+    ("method", "route"),
+    SECONDS_BUCKETS)
+histograms = [request_seconds, db_queries, db_seconds]
+
+
+def render():
+    """
+        all metrics in the Prometheus text format
+    """
+    lines = []
+    for histogram in histograms:
+        lines += histogram.render()
+    return "\n".join(lines) + "\n"
+
+
+def server_timing(stats, seconds):
+    return 'db;dur={:.2f};desc="{} queries", db-slowest;dur={:.2f}, ' \
+        'total;dur={:.2f}'.format(
+            stats.seconds * 1000, stats.count, stats.slowest * 1000,
+            seconds * 1000)
+
+
+class MetricsMiddleware():
+    """
+        count the queries of every request, report them in the
+        Server-Timing header and add them to the per route histograms
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._routes = None
+
+    def route(self, scope):
+        # the path template of the matched route, not the raw path
+        # with ids, so the number of series stays bounded
+        if self._routes is None:
+            self._routes = {route.endpoint: route.path
+                            for route in scope["app"].routes
+                            if hasattr(route, "endpoint")}
+        return self._routes.get(scope.get("endpoint"), "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = QueryStats()
+        query_stats.set(stats)
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(
+                    b"server-timing",
+                    server_timing(stats, time.perf_counter() - started)
+                    .encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            seconds = time.perf_counter() - started
+            method = scope["method"]
+            route = self.route(scope)
+            request_seconds.observe(seconds, method, route, str(status[0]))
+            db_queries.observe(stats.count, method, route)
+            db_seconds.observe(stats.seconds, method, route)
+            if MAX_QUERIES_PER_REQUEST and \
+                    stats.count > MAX_QUERIES_PER_REQUEST:
+                slow_query_log.warning(
+                    "%s %s ran %d queries (%.1f ms), slowest: %s",
+                    method, scope["path"], stats.count,
+                    stats.seconds * 1000, stats.slowest_sql)
@@ -1,41 +1,312 @@
+import argparse
+import re
+import sys
+import peewee
+from datetime import datetime
 from database import db
+from models import MODELS
 
-migration_sqls = [
-    [
-        """
-        CREATE TABLE IF NOT EXISTS User (
-            id int(11) NOT NULL PRIMARY KEY AUTO_INCREMENT,
-            email VARCHAR(50) not null,
-            platform VARCHAR(20) not null,
-            name VARCHAR(50),
-            phone_number VARCHAR(20),
-            occupation VARCHAR(50)
-        )""",
-        []
-    ],
-    [
-        """
-        CREATE TABLE IF NOT EXISTS Post (
-            id int(11) NOT NULL PRIMARY KEY AUTO_INCREMENT,
-            title VARCHAR(240) not null,
-            body TEXT not null,
-            author int(11) not null,
-            created datetime DEFAULT CURRENT_TIMESTAMP
-        )""",
-        []
-    ],
-    [
+# every migration is (version, name, steps) and is applied only once
+# a step is either [sql, params] or a callable returning [sql, params]
+# (or None when there is nothing left to do)
+
+
+def add_index(table, name, columns, unique=False, fulltext=False):
+    """
+        step that creates an index unless it already exists
+        so a migration that failed halfway can be re-run
+    """
+    def step():
+        exists = db.execute_sql(
+            """
+            SELECT 1 FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = DATABASE()
+                AND TABLE_NAME = %s
+                AND INDEX_NAME = %s
+            LIMIT 1""",
+            [table, name]).fetchone()
+        if exists:
+            return None
+        return [
+            "CREATE {}INDEX {} ON {} ({})".format(
+                "UNIQUE " if unique else "FULLTEXT " if fulltext else "",
+                name, table, ", ".join(columns)),
+            []
+        ]
+    return step
+
+
+def drop_index(table, name):
+    """
+        step that drops an index if it still exists
+    """
+    def step():
+        exists = db.execute_sql(
+            """
+            SELECT 1 FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = DATABASE()
+                AND TABLE_NAME = %s
+                AND INDEX_NAME = %s
+            LIMIT 1""",
+            [table, name]).fetchone()
+        if not exists:
+            return None
+        return ["DROP INDEX {} ON {}".format(name, table), []]
+    return step
+
+
+def no_duplicate_emails():
+    """
+        the unique email index cannot be created while users share an
+        email, stop with the list so they can be merged first
+    """
+    cursor = db.execute_sql(
         """
-        CREATE TABLE IF NOT EXISTS Post_Like (
-            id int(11) NOT NULL PRIMARY KEY AUTO_INCREMENT,
-            post_id int(11) not null,
-            user_id int(11) not null,
-            created datetime DEFAULT CURRENT_TIMESTAMP,
-            CONSTRAINT UK_post_user UNIQUE (post_id, user_id)
-        )""",
-        []
-    ]
+        SELECT email, COUNT(*) FROM User
+        GROUP BY email HAVING COUNT(*) > 1
+        LIMIT 20""")
+    duplicates = cursor.fetchall()
+    if duplicates:
+        raise RuntimeError(
+            "Duplicate user emails, merge them first: {}".format(
+                ", ".join("{} ({})".format(*row) for row in duplicates)))
+    return None
+
+
+migrations = [
+    (1, "create tables", [
+        [
+            """
+            CREATE TABLE IF NOT EXISTS User (
+                id int(11) NOT NULL PRIMARY KEY AUTO_INCREMENT,
+                email VARCHAR(50) not null,
+                platform VARCHAR(20) not null,
+                name VARCHAR(50),
+                phone_number VARCHAR(20),
+                occupation VARCHAR(50)
+            )""",
+            []
+        ],
+        [
+            """
+            CREATE TABLE IF NOT EXISTS Post (
+                id int(11) NOT NULL PRIMARY KEY AUTO_INCREMENT,
+                title VARCHAR(240) not null,
+                body TEXT not null,
+                author int(11) not null,
+                created datetime DEFAULT CURRENT_TIMESTAMP
+            )""",
+            []
+        ],
+        [
+            """
+            CREATE TABLE IF NOT EXISTS Post_Like (
+                id int(11) NOT NULL PRIMARY KEY AUTO_INCREMENT,
+                post_id int(11) not null,
+                user_id int(11) not null,
+                created datetime DEFAULT CURRENT_TIMESTAMP,
+                CONSTRAINT UK_post_user UNIQUE (post_id, user_id)
+            )""",
+            []
+        ]
+    ]),
+    (2, "like projections", [
+        [
+            """
+            CREATE TABLE IF NOT EXISTS Post_Stats (
+                post_id int(11) NOT NULL PRIMARY KEY,
+                like_count int(11) NOT NULL DEFAULT 0
+            )""",
+            []
+        ],
+        [
+            """
+            CREATE TABLE IF NOT EXISTS Post_Recent_Like (
+                id int(11) NOT NULL PRIMARY KEY AUTO_INCREMENT,
+                post_id int(11) not null,
+                user_id int(11) not null,
+                created datetime DEFAULT CURRENT_TIMESTAMP,
+                KEY IX_recent_like_post (post_id, created)
+            )""",
+            []
+        ]
+    ]),
+    (3, "indexes for hot queries", [
+        # auth looks up every request's user by email
+        add_index("User", "IX_user_email", ["email"]),
+        add_index("Post", "IX_post_author", ["author", "created"]),
+        add_index("Post", "IX_post_created", ["created"]),
+        add_index("Post_Like", "IX_post_like_post_created",
+                  ["post_id", "created"]),
+    ]),
+    (4, "post search", [
+        add_index("Post", "FT_post_title_body", ["title", "body"],
+                  fulltext=True),
+    ]),
+    (5, "trending", [
+        [
+            """
+            CREATE TABLE IF NOT EXISTS Post_Trending (
+                post_id int(11) NOT NULL PRIMARY KEY,
+                score double NOT NULL,
+                KEY IX_post_trending_score (score)
+            )""",
+            []
+        ]
+    ]),
+    (6, "unique user email", [
+        no_duplicate_emails,
+        # logins insert users with ON DUPLICATE KEY UPDATE on it
+        add_index("User", "UK_user_email", ["email"], unique=True),
+        # the unique index serves the auth lookups now
+        drop_index("User", "IX_user_email"),
+    ]),
+    (7, "user stats", [
+        [
+            """
+            CREATE TABLE IF NOT EXISTS User_Stats (
+                user_id int(11) NOT NULL PRIMARY KEY,
+                post_count int(11) NOT NULL DEFAULT 0,
+                like_count int(11) NOT NULL DEFAULT 0,
+                last_post_at datetime
+            )""",
+            []
+        ]
+    ]),
 ]
 
-for sql, params in migration_sqls:
-    db.execute_sql(sql, params)
+
+def applied_versions():
+    db.execute_sql(
+        """
+        CREATE TABLE IF NOT EXISTS Migration (
+            version int(11) NOT NULL PRIMARY KEY,
+            name VARCHAR(100) not null,
+            applied datetime DEFAULT CURRENT_TIMESTAMP
+        )""")
+    cursor = db.execute_sql("SELECT version FROM Migration")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def migrate():
+    """
+        apply every migration that is not recorded in the Migration table
+    """
+    if not isinstance(db, peewee.MySQLDatabase):
+        # other engines (SQLite for tests) get the schema from the models
+        db.create_tables(MODELS)
+        return
+    done = applied_versions()
+    for version, name, steps in migrations:
+        if version in done:
+            continue
+        print("Applying {} - {}".format(version, name))
+        for step in steps:
+            if callable(step):
+                step = step()
+                if step is None:
+                    continue
+            sql, params = step
+            db.execute_sql(sql, params)
+        db.execute_sql(
+            "INSERT INTO Migration (version, name) VALUES (%s, %s)",
+            [version, name])
+
+
+def explain_queries():
+    """
+        the queries main.py and helper.py run on every request
+    """
+    from models import User, Post
+    from helper import (
+        get_posts_query,
+        get_recent_likes_query,
+        get_likes_query,
+        before_like,
+        get_liked_posts_query,
+        trim_recent_likes_query,
+        get_trending_query,
+        get_user_summary_query,
+        after_cursor,
+        encode_cursor
+    )
+    from search import FullTextSearch
+    feed = get_posts_query().order_by(Post.created, Post.id)
+    queries = {
+        "auth user": User.select().where(User.email == "user@example.com"),
+        "list posts": feed.paginate(1, 3),
+        "list posts cursor": (
+            feed.where(after_cursor(encode_cursor(datetime.now(), 0)))
+                .limit(4)),
+        "list posts for user": feed.where(Post.author == 1),
+        "get post": get_posts_query().where(Post.id == 1),
+        "recent likes": get_recent_likes_query([1, 2, 3]),
+        "list likes": get_likes_query(1).limit(21),
+        "list likes cursor": (
+            get_likes_query(1).where(before_like(datetime.now(), 0))
+            .limit(21)),
+        "liked posts": get_liked_posts_query([1, 2, 3], 1),
+        "trim recent likes": trim_recent_likes_query(1),
+        "trending": get_trending_query(20),
+        "user summary": get_user_summary_query(1),
+    }
+    if isinstance(db, peewee.MySQLDatabase):
+        queries["search"] = FullTextSearch().query("lorem", 21)
+    return queries
+
+
+def check():
+    """
+        run EXPLAIN on the hot queries and report every full table scan
+        the optimizer may still pick a scan for nearly empty tables,
+        so run this against a database with realistic data
+    """
+    if not isinstance(db, peewee.MySQLDatabase):
+        return check_sqlite()
+    failed = []
+    for name, query in explain_queries().items():
+        sql, params = query.sql()
+        cursor = db.execute_sql("EXPLAIN " + sql, params)
+        columns = [column[0] for column in cursor.description]
+        for row in cursor.fetchall():
+            plan = dict(zip(columns, row))
+            table = plan.get("table") or ""
+            # derived tables are built in memory, only base tables matter
+            if plan.get("type") == "ALL" and not table.startswith("<"):
+                failed.append(name)
+                print("FULL SCAN {}: table {}".format(name, table))
+    if not failed:
+        print("All queries use an index")
+    return not failed
+
+
+_sqlite_scan = re.compile(r"SCAN (TABLE \w+ AS )?t\d+\b")
+
+
+def check_sqlite():
+    failed = []
+    for name, query in explain_queries().items():
+        sql, params = query.sql()
+        cursor = db.execute_sql("EXPLAIN QUERY PLAN " + sql, params)
+        for row in cursor.fetchall():
+            detail = row[-1]
+            # "SCAN t1" reads the whole table, "SCAN t1 USING INDEX" does
+            # not, peewee aliases base tables t1, t2... unlike derived ones
+            if _sqlite_scan.match(detail) and "INDEX" not in detail:
+                failed.append(name)
+                print("FULL SCAN {}: {}".format(name, detail))
+    if not failed:
+        print("All queries use an index")
+    return not failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate the database")
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="EXPLAIN the hot queries and fail on full table scans")
+    args = parser.parse_args()
+    if args.check:
+        sys.exit(0 if check() else 1)
+    migrate()
@@ -3,17 +3,28 @@ import peewee
 
 from database import db
 
+# the schema is created by migrate.py, the indexes and defaults below mirror
+# it so the tables can also be created from the models (SQLite for tests)
+
+
+def created_field():
+    return peewee.DateTimeField(
+        constraints=[peewee.SQL("DEFAULT CURRENT_TIMESTAMP")])
+
 
 class User(peewee.Model):
     id = peewee.IntegerField(primary_key=True)
     email = peewee.CharField()
     platform = peewee.CharField()
-    name = peewee.CharField()
-    phone_number = peewee.CharField()
-    occupation = peewee.CharField()
+    name = peewee.CharField(null=True)
+    phone_number = peewee.CharField(null=True)
+    occupation = peewee.CharField(null=True)
 
     class Meta:
         database = db
+        indexes = (
+            (("email",), True),
+        )
 
 
 class Post(peewee.Model):
@@ -21,18 +32,78 @@ class Post(peewee.Model):
     title = peewee.CharField()
     body = peewee.TextField()
     author = peewee.IntegerField()
-    created = peewee.DateTimeField()
+    created = created_field()
 
     class Meta:
         database = db
+        indexes = (
+            (("author", "created"), False),
+            (("created",), False),
+        )
 
 
 class PostLike(peewee.Model):
     id = peewee.IntegerField(primary_key=True)
     post_id = peewee.IntegerField()
     user_id = peewee.IntegerField()
-    created = peewee.DateTimeField()
+    created = created_field()
 
     class Meta:
         database = db
         table_name = "Post_Like"
+        indexes = (
+            (("post_id", "user_id"), True),
+            (("post_id", "created"), False),
+        )
+
+
+class PostStats(peewee.Model):
+    post_id = peewee.IntegerField(primary_key=True)
+    like_count = peewee.IntegerField()
+
+    class Meta:
+        database = db
+        table_name = "Post_Stats"
+
+
+class PostRecentLike(peewee.Model):
+    id = peewee.IntegerField(primary_key=True)
+    post_id = peewee.IntegerField()
+    user_id = peewee.IntegerField()
+    created = created_field()
+
+    class Meta:
+        database = db
+        table_name = "Post_Recent_Like"
+        indexes = (
+            (("post_id", "created"), False),
+        )
+
+
+class PostTrending(peewee.Model):
+    post_id = peewee.IntegerField(primary_key=True)
+    score = peewee.DoubleField()
+
+    class Meta:
+        database = db
+        table_name = "Post_Trending"
+        indexes = (
+            (("score",), False),
+        )
+
+
+class UserStats(peewee.Model):
+    user_id = peewee.IntegerField(primary_key=True)
+    post_count = peewee.IntegerField()
+    # likes received on the posts of the user
+    like_count = peewee.IntegerField()
+    last_post_at = peewee.DateTimeField(null=True)
+
+    class Meta:
+        database = db
+        table_name = "User_Stats"
+
+
+# every table, in creation order
+MODELS = [User, Post, PostLike, PostStats, PostRecentLike, PostTrending,
+          UserStats]
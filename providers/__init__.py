@@ -0,0 +1,43 @@
+import importlib
+import os
+import threading
+from starlette.concurrency import run_in_threadpool
+
+# login providers served by /api/login/<name>, a module of this package each
+# they are imported on the first login, so workers boot without the Google
+# and HTTP client libraries
+LOGIN_PROVIDERS = [name.strip() for name in
+                   os.getenv("LOGIN_PROVIDERS", "google,facebook").split(",")
+                   if name.strip()]
+
+_providers = {}
+_lock = threading.Lock()
+
+
+def _load(name):
+    with _lock:
+        if name not in _providers:
+            module = importlib.import_module("providers." + name)
+            _providers[name] = module.create()
+        return _providers[name]
+
+
+async def get_provider(name):
+    """
+        the provider of a login route, None when it is not enabled
+        a provider has get_email(access_token), which raises ValueError
+        for an invalid token, and aclose()
+    """
+    if name not in LOGIN_PROVIDERS:
+        return None
+    provider = _providers.get(name)
+    if provider is None:
+        # the import takes a while, keep it off the event loop
+        provider = await run_in_threadpool(_load, name)
+    return provider
+
+
+async def close():
+    for provider in list(_providers.values()):
+        await provider.aclose()
+    _providers.clear()
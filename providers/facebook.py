@@ -0,0 +1,111 @@
+import asyncio
+import os
+import time
+import httpx
+from fastapi import HTTPException
+
+FACEBOOK_APP_ID = os.getenv("FACEBOOK_APP_ID")
+FACEBOOK_APP_SECRET = os.getenv("FACEBOOK_APP_SECRET")
+FACEBOOK_GRAPH_URL = os.getenv(
+    "FACEBOOK_GRAPH_URL", "https://graph.facebook.com")
+FACEBOOK_TIMEOUT = float(os.getenv("FACEBOOK_TIMEOUT", 5))
+
+
+class FacebookClient():
+    """
+        async Graph API client sharing one keep-alive connection pool
+        the app access token is fetched once and reused until it expires
+        or Facebook rejects it
+    """
+
+    def __init__(self, app_id, app_secret,
+                 base_url=FACEBOOK_GRAPH_URL, timeout=FACEBOOK_TIMEOUT):
+        self.app_id = app_id
+        self.app_secret = app_secret
+        self.base_url = base_url
+        self.timeout = timeout
+        self._client = None
+        self._lock = None
+        self._app_token = None
+        self._app_token_expires = 0
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url, timeout=self.timeout)
+        return self._client
+
+    async def app_access_token(self, refresh=False):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if (refresh or not self._app_token or
+                    self._app_token_expires < time.monotonic()):
+                await self._fetch_app_access_token()
+            return self._app_token
+
+    async def _fetch_app_access_token(self):
+        res = await self.client.get("/oauth/access_token", params={
+            "client_id": self.app_id,
+            "client_secret": self.app_secret,
+            "grant_type": "client_credentials"})
+        res.raise_for_status()
+        res = res.json()
+        if "access_token" not in res:
+            raise HTTPException(
+                status_code=400,
+                detail="Invalid token")
+        self._app_token = res["access_token"]
+        # app tokens usually never expire and come without expires_in
+        expires_in = res.get("expires_in")
+        self._app_token_expires = (
+            time.monotonic() + int(expires_in) if expires_in
+            else float("inf"))
+
+    async def debug_token(self, access_token):
+        app_access_token = await self.app_access_token()
+        res = await self._debug_token(access_token, app_access_token)
+        if res.status_code == 401:
+            # the cached app token was revoked, get a new one and retry
+            app_access_token = await self.app_access_token(refresh=True)
+            res = await self._debug_token(access_token, app_access_token)
+        res.raise_for_status()
+        return res.json().get("data") or {}
+
+    async def _debug_token(self, access_token, app_access_token):
+        return await self.client.get("/debug_token", params={
+            "input_token": access_token,
+            "access_token": app_access_token})
+
+    async def get_email(self, access_token):
+        """
+            verify the user access_token was issued for our app
+            and return the email of the user
+            raise ValueError if Facebook rejects the token
+        """
+        try:
+            return await self._get_email(access_token)
+        except httpx.HTTPStatusError as e:
+            raise ValueError(str(e))
+
+    async def _get_email(self, access_token):
+        data = await self.debug_token(access_token)
+        if data.get("app_id") != self.app_id:
+            raise HTTPException(
+                status_code=401,
+                detail="Not authorized")
+        res = await self.client.get("/me", params={
+            "access_token": access_token,
+            "fields": "email"})
+        res.raise_for_status()
+        return res.json()["email"]
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+def create():
+    return FacebookClient(FACEBOOK_APP_ID, FACEBOOK_APP_SECRET)
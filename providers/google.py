@@ -0,0 +1,120 @@
+import os
+import re
+import threading
+import time
+import requests
+from google.auth import jwt
+from starlette.concurrency import run_in_threadpool
+
+GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
+GOOGLE_CERTS_URL = os.getenv(
+    "GOOGLE_CERTS_URL", "https://www.googleapis.com/oauth2/v1/certs")
+# start a background refresh this many seconds before the certs expire
+GOOGLE_CERTS_REFRESH_MARGIN = int(
+    os.getenv("GOOGLE_CERTS_REFRESH_MARGIN", 300))
+GOOGLE_ISSUERS = ["accounts.google.com", "https://accounts.google.com"]
+
+_max_age = re.compile(r"max-age=(\d+)")
+
+
+class GoogleCertCache():
+    """
+        Google signing certificates kept for the max-age Google sends
+        so verifying an id token is a local signature check
+    """
+
+    def __init__(self,
+                 certs_url=GOOGLE_CERTS_URL,
+                 refresh_margin=GOOGLE_CERTS_REFRESH_MARGIN,
+                 default_max_age=3600):
+        self.certs_url = certs_url
+        self.refresh_margin = refresh_margin
+        self.default_max_age = default_max_age
+        self.session = requests.Session()
+        self._certs = None
+        self._expires = 0
+        self._fetched = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def get(self):
+        now = time.monotonic()
+        if self._certs is None or now >= self._expires:
+            with self._lock:
+                # another thread may have refreshed while we waited
+                if self._certs is None or time.monotonic() >= self._expires:
+                    self.refresh()
+        elif now >= self._expires - self.refresh_margin:
+            self._refresh_in_background()
+        return self._certs
+
+    def refresh(self):
+        res = self.session.get(self.certs_url, timeout=5)
+        res.raise_for_status()
+        match = _max_age.search(res.headers.get("Cache-Control", ""))
+        max_age = int(match.group(1)) if match else self.default_max_age
+        self._certs = res.json()
+        self._fetched = time.monotonic()
+        self._expires = self._fetched + max_age
+
+    def _refresh_in_background(self):
+        if self._refreshing:
+            return
+        self._refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            with self._lock:
+                self.refresh()
+        except requests.RequestException:
+            # keep serving the current certs until they expire
+            pass
+        finally:
+            self._refreshing = False
+
+    def verify_oauth2_token(self, token, audience):
+        """
+            same checks as google.oauth2.id_token.verify_oauth2_token
+            raise ValueError if the token is invalid
+        """
+        certs = self.get()
+        kid = jwt.decode_header(token).get("kid")
+        if kid not in certs and time.monotonic() - self._fetched > 60:
+            # Google rotated its keys before our copy expired, at most one
+            # refresh a minute so forged key ids can't trigger downloads
+            with self._lock:
+                self.refresh()
+            certs = self._certs
+        idinfo = jwt.decode(token, certs=certs, audience=audience)
+        if idinfo["iss"] not in GOOGLE_ISSUERS:
+            raise ValueError(
+                "Wrong issuer. 'iss' should be one of the following: {}".format(
+                    GOOGLE_ISSUERS))
+        return idinfo
+
+
+class GoogleLogin():
+    """
+        verifies the id tokens of Google Sign-In for our client id
+    """
+
+    def __init__(self, client_id, certs=None):
+        self.client_id = client_id
+        self.certs = certs or GoogleCertCache()
+
+    async def get_email(self, access_token):
+        """
+            raise ValueError if the token is invalid
+        """
+        # may download the certs, keep it off the event loop
+        idinfo = await run_in_threadpool(
+            self.certs.verify_oauth2_token, access_token, self.client_id)
+        return idinfo["email"]
+
+    async def aclose(self):
+        self.certs.session.close()
+
+
+def create():
+    return GoogleLogin(GOOGLE_CLIENT_ID)
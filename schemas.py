@@ -1,3 +1,4 @@
+from typing import List
 from pydantic import BaseModel
 
 
@@ -25,3 +26,11 @@ class AdditionalInfo(BaseModel):
 class PostCreate(BaseModel):
     title: str
     body: str
+
+
+class PostBulk(BaseModel):
+    posts: List[PostCreate]
+
+
+class LikeBatch(BaseModel):
+    post_ids: List[int]
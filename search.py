@@ -0,0 +1,141 @@
+import heapq
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+import peewee
+from playhouse.mysql_ext import Match
+from database import db
+from models import Post
+
+# MySQL skips shorter words (innodb_ft_min_token_size), do the same
+MIN_TOKEN_LENGTH = 3
+_token = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return [token for token in _token.findall(text.lower())
+            if len(token) >= MIN_TOKEN_LENGTH]
+
+
+class FullTextSearch():
+    """
+        search posts with the FULLTEXT index of MySQL (see migrate.py)
+        MySQL keeps the index up to date by itself
+    """
+
+    def search(self, q, limit, after=None):
+        """
+            (post id, score) of the best limit matches after the cursor
+        """
+        return [(row["id"], row["score"])
+                for row in self.query(q, limit, after).dicts()]
+
+    def query(self, q, limit, after=None):
+        score = Match((Post.title, Post.body), q)
+        query = (Post.select(Post.id, score.alias("score"))
+                 .where(score)
+                 .order_by(score.desc(), Post.id.desc())
+                 .limit(limit))
+        if after:
+            last_score, last_id = after
+            query = query.where(
+                (score < last_score) |
+                ((score == last_score) & (Post.id < last_id)))
+        return query
+
+    def add(self, post_id, title, body):
+        pass
+
+
+class InvertedIndex():
+    """
+        in memory index for databases without full text search (SQLite in
+        tests and benchmarks), ranked by BM25 like MySQL's natural language
+        mode
+        built from the Post table on the first search and then kept up to
+        date by add, so it only sees the posts created by this process
+    """
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        # token -> {post id: occurrences}
+        self._postings = defaultdict(dict)
+        self._lengths = {}
+        self._total_length = 0
+        self._built = False
+        self._lock = threading.Lock()
+
+    def build(self):
+        last_id = 0
+        while True:
+            posts = (Post.select(Post.id, Post.title, Post.body)
+                     .where(Post.id > last_id)
+                     .order_by(Post.id)
+                     .limit(self.batch_size)
+                     .tuples())
+            posts = [post for post in posts]
+            for post_id, title, body in posts:
+                self._add(post_id, title, body)
+            if len(posts) < self.batch_size:
+                break
+            last_id = posts[-1][0]
+        self._built = True
+
+    def add(self, post_id, title, body):
+        with self._lock:
+            # not built yet: the first search reads the post from the table
+            if self._built:
+                self._add(post_id, title, body)
+
+    def _add(self, post_id, title, body):
+        if post_id in self._lengths:
+            return
+        tokens = tokenize(title) + tokenize(body)
+        for token, count in Counter(tokens).items():
+            self._postings[token][post_id] = count
+        self._lengths[post_id] = len(tokens)
+        self._total_length += len(tokens)
+
+    def search(self, q, limit, after=None):
+        """
+            (post id, score) of the best limit matches after the cursor
+        """
+        with self._lock:
+            if not self._built:
+                self.build()
+            scores = self._scores(set(tokenize(q)))
+        results = scores.items()
+        if after:
+            # ranked by (score, id) from the best, keep what comes after
+            results = [(post_id, score) for post_id, score in results
+                       if (score, post_id) < tuple(after)]
+        # only the page is sorted, not every match
+        return heapq.nlargest(
+            limit, results, key=lambda result: (result[1], result[0]))
+
+    def _scores(self, tokens):
+        scores = defaultdict(float)
+        documents = len(self._lengths)
+        if not documents:
+            return scores
+        average_length = self._total_length / documents
+        for token in tokens:
+            postings = self._postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (documents - len(postings) + 0.5) /
+                           (len(postings) + 0.5))
+            for post_id, count in postings.items():
+                length = self._lengths[post_id] / average_length
+                scores[post_id] += idf * count * (self.k1 + 1) / (
+                    count + self.k1 * (1 - self.b + self.b * length))
+        return scores
+
+
+def get_search_index():
+    if isinstance(db, peewee.MySQLDatabase):
+        return FullTextSearch()
+    return InvertedIndex()
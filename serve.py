@@ -0,0 +1,66 @@
+"""
+    production server: gunicorn running WEB_CONCURRENCY uvicorn workers
+        python serve.py
+
+    every worker imports the app itself and warms up (see warm_up in
+    main.py) before it accepts connections
+    several workers need RESPONSE_CACHE_BACKEND=redis, with the memory
+    backend the response cache, the user cache and the users who wrote
+    lately are kept by each worker and the others would serve stale data
+    SIGTERM: workers stop accepting, finish the requests in flight for up
+    to GRACEFUL_TIMEOUT seconds and close their connections
+    SIGHUP: rolling reload, new workers with the current code start, the
+    old ones are stopped gracefully once they are up, the listening socket
+    stays open in the master so no connection is refused
+"""
+import multiprocessing
+import os
+from dotenv import load_dotenv
+from gunicorn.app.base import BaseApplication
+
+load_dotenv()
+
+
+def workers():
+    """
+        WEB_CONCURRENCY, or one per core when the caches are shared
+    """
+    workers = int(os.getenv("WEB_CONCURRENCY") or 0)
+    if os.getenv("RESPONSE_CACHE_BACKEND", "memory") == "redis":
+        return workers or multiprocessing.cpu_count()
+    if workers > 1:
+        raise SystemExit(
+            "WEB_CONCURRENCY={} needs RESPONSE_CACHE_BACKEND=redis, the "
+            "memory caches are not shared by the workers".format(workers))
+    return 1
+
+
+def options():
+    return {
+        "bind": os.getenv("BIND", "0.0.0.0:8000"),
+        "workers": workers(),
+        "worker_class": "uvicorn.workers.UvicornWorker",
+        "graceful_timeout": int(os.getenv("GRACEFUL_TIMEOUT", 30)),
+        # a worker silent for this long is killed and replaced
+        "timeout": int(os.getenv("WORKER_TIMEOUT", 60)),
+        "keepalive": int(os.getenv("KEEPALIVE", 5)),
+        "pidfile": os.getenv("PIDFILE") or None,
+        # the app is imported by the workers, not the master, so a reload
+        # picks up new code
+        "preload_app": False,
+    }
+
+
+class Server(BaseApplication):
+
+    def load_config(self):
+        for name, value in options().items():
+            self.cfg.set(name, value)
+
+    def load(self):
+        from main import app
+        return app
+
+
+if __name__ == "__main__":
+    Server().run()
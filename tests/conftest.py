@@ -0,0 +1,106 @@
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import pytest
+
+# the modules read their settings when imported, the tests run on a SQLite
+# database of their own, the values of .env are not overridden
+os.environ.update({
+    "DB_ENGINE": "sqlite",
+    "DB_NAME": os.path.join(tempfile.mkdtemp(), "test.db"),
+    "DB_POOL": "false",
+    "DB_REPLICAS": "",
+    "ASYNC_DB": "false",
+    "RESPONSE_CACHE_BACKEND": "memory",
+    "WARM_PATHS": "",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+import migrate  # noqa: E402
+from cache import MemoryBackend, RedisBackend, ResponseCache  # noqa: E402
+from database import db  # noqa: E402
+from models import MODELS, Post, User  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+migrate.migrate()
+
+
+@pytest.fixture(scope="session")
+def client():
+    with TestClient(main.app) as client:
+        yield client
+
+
+@pytest.fixture(autouse=True)
+def clean(monkeypatch):
+    """
+        empty tables, caches and rate limits for every test
+    """
+    with db.connection_context():
+        for model in reversed(MODELS):
+            model.delete().execute()
+    monkeypatch.setattr(main, "response_cache", ResponseCache(
+        MemoryBackend(main.RESPONSE_CACHE_SIZE, main.RESPONSE_CACHE_TTL)))
+    main.auth_handler.user_cache.clear()
+    for limiter in main.rate_limiters.values():
+        limiter._buckets.clear()
+    yield
+
+
+@pytest.fixture
+def redis_cache(monkeypatch):
+    """
+        the response cache and the user cache in a fake Redis server, like
+        with RESPONSE_CACHE_BACKEND=redis
+    """
+    fakeredis = pytest.importorskip("fakeredis")
+    import redis
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        redis.Redis, "from_url",
+        classmethod(lambda cls, url: fakeredis.FakeRedis(server=server)))
+    backend = RedisBackend("redis://test", main.RESPONSE_CACHE_TTL)
+    monkeypatch.setattr(main, "RESPONSE_CACHE_BACKEND", "redis")
+    monkeypatch.setattr(main, "response_cache", ResponseCache(backend))
+    monkeypatch.setattr(main.auth_handler, "user_cache", backend.ttl_cache(
+        "auth:", main.auth_handler.user_cache.ttl))
+    return backend
+
+
+@pytest.fixture
+def users():
+    """
+        ids of three users with their extra information
+    """
+    with db.connection_context():
+        return [User.create(
+            id=i, email="user{}@example.com".format(i), platform="google",
+            name="User {}".format(i), occupation="tester").id
+            for i in range(1, 4)]
+
+
+@pytest.fixture
+def posts(users):
+    """
+        ids of five posts, by the first two users
+    """
+    created = datetime(2022, 1, 1)
+    with db.connection_context():
+        return [Post.create(
+            id=i, title="Post {}".format(i), body="body {}".format(i),
+            author=users[i % 2], created=created + timedelta(minutes=i)).id
+            for i in range(1, 6)]
+
+
+@pytest.fixture
+def auth():
+    """
+        headers of a request of the user
+    """
+    def headers(user_id):
+        return {"Authorization": "Bearer " + main.auth_handler.encode_token(
+            "user{}@example.com".format(user_id))}
+    return headers
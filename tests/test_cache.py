@@ -0,0 +1,80 @@
+import pytest
+
+from database import db
+from models import Post
+
+# post 1 is by user 2, user 1 reads, the others write so the reads are not
+# sent past the cache for a user who just wrote
+PATHS = ("/api/posts", "/api/posts/1", "/api/users/2/posts")
+
+
+def first_post(response):
+    body = response.json()
+    return body if "id" in body else body[0]
+
+
+@pytest.fixture
+def read(client, auth):
+    def get(path):
+        response = client.get(path, headers=auth(1))
+        assert response.status_code == 200
+        return first_post(response)
+    return get
+
+
+@pytest.fixture
+def cached(posts, read):
+    """
+        cache the responses then change post 1 behind the cache, what the
+        responses show of the change tells if they were built again
+    """
+    for path in PATHS:
+        read(path)
+    with db.connection_context():
+        Post.update(title="Changed").where(Post.id == 1).execute()
+    assert [read(path)["title"] for path in PATHS] == ["Post 1"] * 3
+
+
+def test_like_evicts_responses(client, auth, read, cached):
+    assert client.post(
+        "/api/posts/1/likes", headers=auth(3)).status_code == 200
+    for path in PATHS:
+        post = read(path)
+        assert post["title"] == "Changed"
+        assert post["like_count"] == 1
+
+
+def test_rename_evicts_responses(client, auth, read, cached):
+    assert client.patch("/api/users/self", headers=auth(2), json={
+        "name": "Renamed", "occupation": "tester"}).status_code == 204
+    for path in PATHS:
+        post = read(path)
+        assert post["title"] == "Changed"
+        assert post["author_name"] == "Renamed"
+
+
+def test_rename_of_a_liker_evicts_responses(client, auth, read, posts):
+    client.post("/api/posts/1/likes", headers=auth(3))
+    assert [read(path)["likes"][0]["name"] for path in PATHS] == [
+        "User 3"] * 3
+    assert client.patch("/api/users/self", headers=auth(3), json={
+        "name": "Renamed", "occupation": "tester"}).status_code == 204
+    assert [read(path)["likes"][0]["name"] for path in PATHS] == [
+        "Renamed"] * 3
+
+
+def test_new_post_evicts_responses(client, auth, read, cached):
+    # the feed shows three posts a page, the new one is on the second
+    last_page = ("/api/posts?page=2", "/api/users/2/posts")
+    assert [len(client.get(path, headers=auth(1)).json())
+            for path in last_page] == [2, 3]
+    assert client.get("/api/posts/6", headers=auth(1)).json() is None
+
+    response = client.post("/api/posts", headers=auth(2), json={
+        "title": "New", "body": "new body"})
+    assert response.json()["id"] == 6
+
+    assert read("/api/posts")["title"] == "Changed"
+    assert read("/api/posts/6")["title"] == "New"
+    for path in last_page:
+        assert client.get(path, headers=auth(1)).json()[-1]["title"] == "New"
@@ -0,0 +1,82 @@
+import asyncio
+
+import httpx
+import pytest
+
+from providers.facebook import FacebookClient
+
+
+class Graph():
+    """
+        a fake Graph API counting the requests of every path
+        app tokens listed in revoked are rejected by debug_token
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.tokens = 0
+        self.revoked = set()
+
+    def handler(self, request):
+        self.calls.append(request.url.path)
+        params = request.url.params
+        if request.url.path == "/oauth/access_token":
+            self.tokens += 1
+            return httpx.Response(200, json={
+                "access_token": "app-token-{}".format(self.tokens)})
+        if request.url.path == "/debug_token":
+            if params["access_token"] in self.revoked:
+                return httpx.Response(401, json={})
+            return httpx.Response(200, json={"data": {"app_id": "app"}})
+        if request.url.path == "/me":
+            return httpx.Response(200, json={
+                "email": "{}@example.com".format(params["access_token"])})
+        return httpx.Response(404)
+
+
+@pytest.fixture
+def graph():
+    return Graph()
+
+
+@pytest.fixture
+def facebook(graph):
+    client = FacebookClient("app", "secret", base_url="https://graph.test")
+    client._client = httpx.AsyncClient(
+        base_url=client.base_url, transport=httpx.MockTransport(graph.handler))
+    return client
+
+
+def logins(facebook, *access_tokens):
+    async def run():
+        try:
+            return [await facebook.get_email(access_token)
+                    for access_token in access_tokens]
+        finally:
+            await facebook.aclose()
+    return asyncio.run(run())
+
+
+def test_app_token_is_fetched_once(facebook, graph):
+    assert logins(facebook, "alice", "bob") == [
+        "alice@example.com", "bob@example.com"]
+    assert graph.calls == [
+        "/oauth/access_token", "/debug_token", "/me",
+        "/debug_token", "/me"]
+
+
+def test_revoked_app_token_is_fetched_again(facebook, graph):
+    graph.revoked.add("app-token-1")
+    assert logins(facebook, "alice", "bob") == [
+        "alice@example.com", "bob@example.com"]
+    assert graph.calls == [
+        "/oauth/access_token", "/debug_token",
+        "/oauth/access_token", "/debug_token", "/me",
+        "/debug_token", "/me"]
+
+
+def test_retries_once_after_401(facebook, graph):
+    graph.revoked.update({"app-token-1", "app-token-2"})
+    with pytest.raises(ValueError):
+        logins(facebook, "alice")
+    assert graph.calls.count("/oauth/access_token") == 2
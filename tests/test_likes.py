@@ -0,0 +1,31 @@
+from peewee import Value
+
+import helper
+import main
+from database import db
+from models import Post, PostLike, PostRecentLike, PostStats, UserStats
+
+
+def test_batch_like_counts_a_concurrent_like_once(
+        client, posts, auth, monkeypatch):
+    # a single like committed after the batch checked the liked posts
+    with db.connection_context():
+        helper.add_like(1, 1)
+    monkeypatch.setattr(
+        main, "get_liked_posts_query",
+        lambda post_ids, user_id: (
+            Post.select(Post.id, Value(None).alias("like_id"))
+            .where(Post.id.in_(post_ids))))
+
+    response = client.post("/api/posts/likes/batch", headers=auth(1),
+                           json={"post_ids": [1, 2, 3]})
+
+    assert response.json() == {
+        "liked": [2, 3], "already_liked": [1], "missing": []}
+    with db.connection_context():
+        assert PostLike.select().count() == 3
+        assert PostRecentLike.select().count() == 3
+        assert dict(PostStats.select().tuples()) == {1: 1, 2: 1, 3: 1}
+        # posts 1 and 3 are by user 2, post 2 by user 1
+        assert dict(UserStats.select(
+            UserStats.user_id, UserStats.like_count).tuples()) == {1: 1, 2: 2}
@@ -0,0 +1,55 @@
+import asyncio
+import functools
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def on_loop(redis_cache, monkeypatch):
+    """
+        names of the Redis backend calls made on the event loop thread
+    """
+    calls = []
+
+    def watch(func):
+        @functools.wraps(func)
+        def call(*args, **kwargs):
+            try:
+                asyncio.get_running_loop()
+                calls.append(func.__name__)
+            except RuntimeError:
+                pass
+            return func(*args, **kwargs)
+        return call
+
+    for name in ("get", "set", "version", "invalidate"):
+        monkeypatch.setattr(
+            redis_cache, name, watch(getattr(redis_cache, name)))
+    return calls
+
+
+def test_async_reads_are_cached_in_redis(
+        client, posts, auth, redis_cache, on_loop):
+    for path in ("/api/posts", "/api/posts/1", "/api/users/1/posts"):
+        response = client.get(path, headers=auth(1))
+        assert response.status_code == 200
+        cached = client.get(path, headers=dict(
+            auth(1), **{"If-None-Match": response.headers["etag"]}))
+        assert cached.status_code == 304
+    assert redis_cache.get("post:1") is not None
+    assert on_loop == []
+
+
+def test_async_like_invalidates_redis(client, posts, auth, on_loop):
+    before = client.get("/api/posts/1", headers=auth(1)).json()
+    assert before["like_count"] == 0
+
+    response = client.post("/api/posts/1/likes", headers=auth(2))
+    assert response.status_code == 200
+
+    after = client.get("/api/posts/1", headers=auth(1)).json()
+    assert after["like_count"] == 1
+    assert [like["user_id"] for like in after["likes"]] == [2]
+    assert on_loop == []
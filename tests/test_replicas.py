@@ -0,0 +1,32 @@
+import os
+
+import database
+from database import Replicas, connect_replica
+
+
+def test_check_takes_out_and_puts_back_replicas(tmp_path):
+    broken = str(tmp_path / "missing" / "replica.db")
+    replicas = Replicas(
+        [connect_replica(0, str(tmp_path / "replica.db")),
+         connect_replica(1, broken)], 1, 60)
+
+    replicas.check()
+    assert replicas.health() == [
+        {"replica": str(tmp_path / "replica.db"), "healthy": True},
+        {"replica": broken, "healthy": False}]
+
+    # the replica came back, it is used again before the retry time
+    os.mkdir(tmp_path / "missing")
+    replicas.check()
+    assert [replica["healthy"] for replica in replicas.health()] == [
+        True, True]
+    assert replicas.pick() is not None
+
+
+def test_health_names_mysql_replicas_by_host(monkeypatch):
+    monkeypatch.setattr(database, "DB_ENGINE", "mysql")
+    replicas = Replicas(
+        [connect_replica(0, "replica-a"), connect_replica(1, "replica-b:3307")],
+        1, 60)
+    assert [replica["replica"] for replica in replicas.health()] == [
+        "replica-a:{}".format(database.DB_PORT), "replica-b:3307"]
@@ -0,0 +1,110 @@
+import logging
+import os
+import threading
+from playhouse.shortcuts import model_to_dict
+from database import (
+    db,
+    db_state_default,
+    DB_POOL_MAX_SIZE,
+    StatsPooledMySQLDatabase
+)
+from models import User, UserStats
+
+# work done by every worker at startup, before it takes traffic
+# connections opened at once and left idle in the pool
+WARM_DB_CONNECTIONS = int(os.getenv("WARM_DB_CONNECTIONS", 4))
+# users of the latest posts loaded into the user cache of auth
+WARM_USERS = int(os.getenv("WARM_USERS", 100))
+# GET requests served once to fill the response cache, comma separated
+WARM_PATHS = [path.strip() for path in os.getenv(
+    "WARM_PATHS", "/api/posts,/api/posts?cursor=").split(",")
+    if path.strip()]
+
+log = logging.getLogger("warmup")
+
+
+def open_connections(count=WARM_DB_CONNECTIONS):
+    """
+        open count connections at the same time and give them back, so the
+        pool has them idle for the first requests
+        without pool it only checks that the database answers
+    """
+    if not isinstance(db, StatsPooledMySQLDatabase):
+        count = 1
+    count = max(1, min(count, DB_POOL_MAX_SIZE))
+    # every connection is held until all are open, or the pool would hand
+    # the same one to every thread
+    barrier = threading.Barrier(count, timeout=30)
+    errors = []
+
+    def open_connection():
+        # a connection state of its own, like a request
+        db._state._state.set(db_state_default.copy())
+        db._state.reset()
+        try:
+            db.execute_sql("SELECT 1")
+            barrier.wait()
+        except threading.BrokenBarrierError:
+            pass
+        except Exception as e:
+            errors.append(e)
+            barrier.abort()
+        finally:
+            if not db.is_closed():
+                db.close()
+
+    threads = [threading.Thread(target=open_connection)
+               for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return count
+
+
+def recent_users(limit=WARM_USERS):
+    """
+        users of the latest posts, the most likely to send requests
+    """
+    with db.connection_context():
+        users = (User.select()
+                 .join(UserStats, on=(UserStats.user_id == User.id))
+                 .order_by(UserStats.last_post_at.desc())
+                 .limit(limit))
+        return [model_to_dict(user) for user in users]
+
+
+async def request(app, path, headers):
+    """
+        serve a GET request with the app without a server, returns the
+        status
+    """
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [(name.lower().encode(), value.encode())
+                    for name, value in headers.items()],
+        "client": ("127.0.0.1", 0),
+        "server": ("127.0.0.1", 80),
+    }
+    status = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    await app(scope, receive, send)
+    return status[0] if status else None